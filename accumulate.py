@@ -0,0 +1,56 @@
+import tensorflow as tf
+
+
+"""
+梯度累积：显存/内存只放得下一个小 batch 时，连续 k 个 micro batch 的梯度累加到不参与训练的缓存变量中，
+第 k 个 micro batch 时用它们的平均值更新一次参数，效果相当于 batch_size * k 的大 batch，模型代码不需要改动。
+"""
+
+
+class Accumulator:
+    def __init__(self, opt, grads_and_vars, k=1, global_step=None):
+        """
+        :param opt:            优化器
+        :param grads_and_vars: [(grad, var), ...]，例如 compute_gradients 或 multi_tower 合并后的梯度
+        :param k:              每累积多少个 micro batch 更新一次参数，k=1 时就是普通的 apply_gradients
+        """
+        if k < 1:
+            raise Exception('k should be at least 1, but got %s' % k)
+        self.k = k
+        grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+        if k == 1:
+            self.train_op = opt.apply_gradients(grads_and_vars, global_step)
+            self.accumulate_op = self.train_op
+            self.init_op = tf.no_op()
+            return
+
+        # control_dependencies(None)：调用者可能处在 control_dependencies(UPDATE_OPS) 之中，缓存的初始化不能依赖输入数据
+        with tf.control_dependencies(None), tf.variable_scope('accumulate'):
+            # 放在 LOCAL_VARIABLES 中，Saver 不保存它们，旧的模型文件仍然可以恢复
+            self.buffers = [tf.Variable(tf.zeros(v.shape, v.dtype.base_dtype), trainable=False,
+                                        collections=[tf.GraphKeys.LOCAL_VARIABLES], name=v.op.name.replace('/', '_'))
+                            for _, v in grads_and_vars]
+        self.init_op = tf.variables_initializer(self.buffers)
+
+        adds = []
+        for (g, _), buffer in zip(grads_and_vars, self.buffers):
+            if isinstance(g, tf.IndexedSlices):
+                adds.append(tf.scatter_add(buffer, g.indices, g.values))
+            else:
+                adds.append(tf.assign_add(buffer, g))
+        # 前 k-1 个 micro batch 只累加梯度
+        self.accumulate_op = tf.group(*adds)
+
+        # 第 k 个 micro batch：累加、用平均梯度更新参数、清零缓存，在一次 session.run 中按顺序完成
+        with tf.control_dependencies([self.accumulate_op]):
+            mean = [(buffer.read_value() / k, v) for buffer, (_, v) in zip(self.buffers, grads_and_vars)]
+        # 优化器的slot变量在这里创建，不能放在上面的 control_dependencies 中
+        apply_op = opt.apply_gradients(mean, global_step)
+        with tf.control_dependencies([apply_op]):
+            self.train_op = tf.group(*[tf.assign(buffer, tf.zeros_like(buffer)) for buffer in self.buffers])
+
+    def step_op(self, step):
+        """
+        第 step 个 micro batch（从0开始）应该运行的op；最后不足 k 个的 micro batch 不会更新参数
+        """
+        return self.train_op if (step + 1) % self.k == 0 else self.accumulate_op
@@ -0,0 +1,290 @@
+import importlib.util
+import time
+import numpy as np
+
+
+"""
+一个很小的 NumPy 多层感知机：
+    任意层数（layers=[输入节点数, 隐藏层1, ..., 输出节点数]），每层可以选择不同的激活函数；
+    正向、反向传播都是整个 mini batch 一起做矩阵运算；
+    各层的输出、误差项、梯度都写入预先分配好的缓存，缓存按见过的最大 batch 分配，较小的 batch（例如每轮最后不满的一批）
+    使用缓存的前几行，训练过程中不再申请内存；
+    优化器有 SGD 和 Adam。
+p34.bike.py 和 p33.back_propagation.py 中手写的两层 sigmoid 网络都可以用它代替。
+"""
+
+
+def _sigmoid(z):
+    np.negative(z, out=z)
+    np.exp(z, out=z)
+    z += 1
+    np.reciprocal(z, out=z)
+
+
+def _sigmoid_backward(a, delta, tmp):
+    # sigmoid'(z) = a * (1 - a)
+    np.subtract(1, a, out=tmp)
+    tmp *= a
+    delta *= tmp
+
+
+def _tanh_backward(a, delta, tmp):
+    # tanh'(z) = 1 - a^2
+    np.multiply(a, a, out=tmp)
+    np.subtract(1, tmp, out=tmp)
+    delta *= tmp
+
+
+def _relu(z):
+    np.maximum(z, 0, out=z)
+
+
+def _relu_backward(a, delta, tmp):
+    np.greater(a, 0, out=tmp)
+    delta *= tmp
+
+
+def _identity(z):
+    pass
+
+
+def _identity_backward(a, delta, tmp):
+    pass
+
+
+# 激活函数：(原地计算正向, 用该层输出a原地把误差项乘上导数)
+activations = {
+    'sigmoid': (_sigmoid, _sigmoid_backward),
+    'tanh': (lambda z: np.tanh(z, out=z), _tanh_backward),
+    'relu': (_relu, _relu_backward),
+    'identity': (_identity, _identity_backward),
+}
+
+
+class SGD:
+    def __init__(self, lr=0.01):
+        self.lr = lr
+
+    def prepare(self, params):
+        pass
+
+    def step(self, params, grads):
+        for param, grad in zip(params, grads):
+            grad *= self.lr
+            param -= grad
+
+
+class Adam:
+    def __init__(self, lr=0.001, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        self.lr = lr
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+
+    def prepare(self, params):
+        self.t = 0
+        self.m = [np.zeros_like(p) for p in params]
+        self.v = [np.zeros_like(p) for p in params]
+
+    def step(self, params, grads):
+        self.t += 1
+        lr = self.lr * (1 - self.beta2 ** self.t) ** 0.5 / (1 - self.beta1 ** self.t)
+        for param, grad, m, v in zip(params, grads, self.m, self.v):
+            m *= self.beta1
+            m += (1 - self.beta1) * grad
+            v *= self.beta2
+            np.multiply(grad, grad, out=grad)
+            grad *= 1 - self.beta2
+            v += grad
+            # grad 已经用完，作为临时缓存计算更新量
+            np.sqrt(v, out=grad)
+            grad += self.epsilon
+            np.divide(m, grad, out=grad)
+            grad *= lr
+            param -= grad
+
+
+class MLP:
+    def __init__(self, layers, activation='sigmoid', output_activation='identity', optimizer=None, bias=True,
+                 dtype=np.float64, seed=None):
+        """
+        :param layers:            各层节点数，例如 [56, 8, 1]
+        :param activation:        隐藏层的激活函数名，也可以是每一层（包括输出层）激活函数名的列表
+        :param output_activation: activation 不是列表时，输出层的激活函数
+        :param optimizer:         SGD 或 Adam 对象，默认 SGD(0.01)
+        :param bias:              是否使用偏置，p33/p34 中的网络都没有偏置
+        :param dtype:             权重和计算使用的浮点类型
+        :param seed:              初始化权重的随机种子，None 表示使用 np.random 的全局状态
+        """
+        if len(layers) < 2:
+            raise Exception('layers should contain at least the input and output size, but got %s' % (layers,))
+        if isinstance(activation, str):
+            activation = [activation] * (len(layers) - 2) + [output_activation]
+        if len(activation) != len(layers) - 1:
+            raise Exception('expect %d activations, but got %d' % (len(layers) - 1, len(activation)))
+        for name in activation:
+            if name not in activations:
+                raise Exception('unknown activation %s, should be one of %s' % (name, list(activations)))
+
+        self.layers = list(layers)
+        self.activation = list(activation)
+        self.dtype = dtype
+        self.bias = bias
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        # 与 p33/p34 相同的初始化：标准差为 输入节点数 ** -0.5 的正态分布
+        self.weights = [rng.normal(0.0, n_in ** -0.5, size=(n_in, n_out)).astype(dtype)
+                        for n_in, n_out in zip(layers[:-1], layers[1:])]
+        self.biases = [np.zeros(n_out, dtype) for n_out in layers[1:]] if bias else []
+        self.grad_weights = [np.zeros_like(w) for w in self.weights]
+        self.grad_biases = [np.zeros_like(b) for b in self.biases]
+
+        self.optimizer = SGD() if optimizer is None else optimizer
+        self.optimizer.prepare(self.params())
+        self._batch_size = None
+        self._capacity = 0
+
+    def params(self):
+        return self.weights + self.biases
+
+    def grads(self):
+        return self.grad_weights + self.grad_biases
+
+    def _allocate(self, n):
+        """
+        各层输出、误差项和临时缓存只在 batch 超过已分配的行数时重新分配，
+        较小的 batch 使用缓存前 n 行的视图（按行切片仍是连续内存，可以作为 out 参数）
+        """
+        if self._batch_size == n:
+            return
+        if n > self._capacity:
+            self._capacity = n
+            self._buffers = [[np.empty((n, size), self.dtype) for size in self.layers[1:]] for _ in range(3)]
+        self._batch_size = n
+        self._outputs, self._deltas, self._tmps = [[b[:n] for b in buffers] for buffers in self._buffers]
+
+    def forward(self, features):
+        """
+        正向传播，返回输出层的结果。返回的是内部缓存，下一次调用时会被覆盖
+        """
+        a = np.asarray(features, dtype=self.dtype)
+        self._allocate(len(a))
+        self._input = a
+        for i, (w, out) in enumerate(zip(self.weights, self._outputs)):
+            np.matmul(a, w, out=out)
+            if self.bias:
+                out += self.biases[i]
+            activations[self.activation[i]][0](out)
+            a = out
+        return a
+
+    def backward(self, targets):
+        """
+        在 forward 之后调用，对损失 0.5 * mean(sum((output - targets)^2)) 求梯度，写入 grad_weights/grad_biases。
+        返回这个 batch 的均方误差（复用正向传播的结果，不再重新计算）
+        """
+        n = self._batch_size
+        y = np.asarray(targets, dtype=self.dtype).reshape(n, -1)
+        delta = self._deltas[-1]
+        np.subtract(self._outputs[-1], y, out=delta)
+        loss = float(np.vdot(delta, delta)) / delta.size
+
+        for i in range(len(self.weights) - 1, -1, -1):
+            activations[self.activation[i]][1](self._outputs[i], delta, self._tmps[i])
+            a = self._input if i == 0 else self._outputs[i - 1]
+            np.matmul(a.T, delta, out=self.grad_weights[i])
+            self.grad_weights[i] /= n
+            if self.bias:
+                np.sum(delta, axis=0, out=self.grad_biases[i])
+                self.grad_biases[i] /= n
+            if i > 0:
+                np.matmul(delta, self.weights[i].T, out=self._deltas[i - 1])
+                delta = self._deltas[i - 1]
+        return loss
+
+    def train_batch(self, features, targets):
+        """
+        一个 mini batch 的正向传播、反向传播和参数更新，返回更新前这个 batch 的均方误差
+        """
+        self.forward(features)
+        loss = self.backward(targets)
+        self.optimizer.step(self.params(), self.grads())
+        return loss
+
+    def predict(self, features):
+        """
+        只做正向传播，不使用训练的缓存，评估时换成整个验证集也不会让训练的缓存重新分配
+        """
+        a = np.asarray(features, dtype=self.dtype)
+        for i, w in enumerate(self.weights):
+            a = np.matmul(a, w)
+            if self.bias:
+                a += self.biases[i]
+            activations[self.activation[i]][0](a)
+        return a
+
+    # 与 p34 中 NeuralNetwork 相同的接口，可以直接交给 train_model / EvalSchedule / test 使用
+    train = train_batch
+    run = predict
+
+
+def _load(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def benchmark_bike(epochs=200, batch_size=128, hidden_nodes=8, learning_rate=0.5):
+    """
+    同样的初始权重、同样的 mini batch，p34 的逐条记录训练、整批训练，与 MLP（SGD）的吞吐量（行/秒）对比
+    """
+    bike = _load('p34_bike', 'p34.bike.py')
+    arrays, _ = bike.load_dataset()
+    X = np.array(arrays['train_features'], dtype=np.float32)
+    y = np.array(arrays['train_targets'][:, 0], dtype=np.float32)
+    batches = [np.random.randint(0, len(X), batch_size) for _ in range(epochs)]
+    base = bike.NeuralNetwork(X.shape[1], hidden_nodes, 1, learning_rate)
+
+    result = {}
+    for name in ('per_record', 'batched', 'mlp_sgd', 'mlp_adam'):
+        if name.startswith('mlp'):
+            optimizer = SGD(learning_rate) if name == 'mlp_sgd' else Adam(0.01)
+            network = MLP([X.shape[1], hidden_nodes, 1], optimizer=optimizer, bias=False, dtype=np.float32)
+            network.weights[0][:], network.weights[1][:] = base.weights_input_to_hidden, base.weights_hidden_to_output
+            train = network.train_batch
+        else:
+            network = bike.NeuralNetwork(X.shape[1], hidden_nodes, 1, learning_rate, np.float32)
+            network.weights_input_to_hidden[:] = base.weights_input_to_hidden
+            network.weights_hidden_to_output[:] = base.weights_hidden_to_output
+            train = network.train_per_record if name == 'per_record' else network.train
+        start = time.perf_counter()
+        for batch in batches:
+            train(X[batch], y[batch])
+        cost = time.perf_counter() - start
+        result[name] = {'rows_per_second': epochs * batch_size / cost,
+                        'train_loss': bike.MSE(network.run(X).T, y)}
+    return result
+
+
+def benchmark_admissions(epochs=200, n_hidden=2, lr=0.01):
+    """
+    p33 的逐条记录训练、整批训练，与 MLP（sigmoid 输出层、SGD）的吞吐量（行/秒）对比
+    """
+    p33 = _load('p33_back_propagation', 'p33.back_propagation.py')
+    x_train, y_train, x_test, y_test = p33.data_transform(p33.admissions)
+    x_train, y_train = np.asarray(x_train, dtype=np.float64), np.asarray(y_train, dtype=np.float64)
+
+    result = {}
+    for name, work in (('per_record', p33.bp_work_per_record), ('batched', p33.bp_work), ('mlp', p33.mlp_work)):
+        start = time.perf_counter()
+        work(x_train, y_train, x_test, y_test, lr=lr, epoches=epochs, n_hidden=n_hidden, verbose=False)
+        cost = time.perf_counter() - start
+        result[name] = {'rows_per_second': (epochs - 1) * len(x_train) / cost}
+    return result
+
+
+if __name__ == '__main__':
+    for title, result in (('bike', benchmark_bike()), ('admissions', benchmark_admissions())):
+        for name, r in result.items():
+            print('%-10s %-10s %12.0f rows/s' % (title, name, r['rows_per_second']),
+                  'train loss = %.4f' % r['train_loss'] if 'train_loss' in r else '')
@@ -0,0 +1,138 @@
+import tensorflow as tf
+import os
+
+
+"""
+数据并行的多塔训练，p23 ~ p32 共用：
+    每个设备上建一个塔（Sub_tensors），各塔共享同一套变量，各自计算一份样本的梯度；
+    在第一个设备上合并各塔的梯度，只产生一个 train_op。
+设备可以是 GPU（'/gpu:0', '/gpu:1', ...），也可以是多个虚拟CPU设备（'/cpu:0', '/cpu:1', ...），
+没有GPU的机器上用后者让各个塔分散到不同的CPU设备上，而不是被 allow_soft_placement 全部放到同一个设备上。
+embedding 的稀疏梯度在合并时按行去重（见 merge_grads），每步实际更新的行数由 Towers.total_rows_touched 给出：
+p23 每步打印并写入 summary，p25 ~ p30 写入 summary（rows_touched），p24 没有稀疏梯度。
+"""
+
+
+def get_gpus():
+    value = os.getenv('CUDA_VISIBLE_DEVICES', '0')
+    return len(value.split(','))
+
+
+def num_towers(device_type='gpu', towers=0, gpus=None):
+    """
+    :param device_type: 'gpu' 或 'cpu'
+    :param towers: 指定的塔的数量，0 表示使用默认值
+    :param gpus:   gpu 模式下的默认值，None 表示按 CUDA_VISIBLE_DEVICES 计数；cpu 模式下默认为CPU核数
+    :return: 塔的数量
+    """
+    if device_type not in ('gpu', 'cpu'):
+        raise Exception('device_type should be gpu or cpu, but got %s' % device_type)
+    if towers < 0:
+        raise Exception('towers should not be negative, but got %s' % towers)
+    if towers > 0:
+        return towers
+    if device_type == 'cpu':
+        return os.cpu_count()
+    return get_gpus() if gpus is None else gpus
+
+
+def get_devices(device_type='gpu', num=None):
+    """
+    :param device_type: 'gpu' 或 'cpu'
+    :param num: 设备（塔）的数量，默认值见 num_towers
+    :return: 设备名的列表
+    """
+    if num is None:
+        num = num_towers(device_type)
+    elif device_type not in ('gpu', 'cpu'):
+        raise Exception('device_type should be gpu or cpu, but got %s' % device_type)
+    return ['/%s:%d' % (device_type, index) for index in range(num)]
+
+
+def session_config(device_type='gpu', num=None, threads=None):
+    """
+    返回创建Session用的 ConfigProto。
+    device_type='cpu' 时用 device_count 建立 num 个虚拟CPU设备，每个塔一个；
+    TF1 的CPU设备共用进程内的线程池，所以按塔的数量划分线程：每个算子内部最多用 threads // num 个线程，
+    同时允许 num 个算子并行执行，各个塔的计算可以同时进行，而不是互相抢占同一批线程。
+    """
+    conf = tf.ConfigProto()
+    conf.allow_soft_placement = True
+    if device_type == 'cpu':
+        num = len(get_devices(device_type, num))
+        threads = os.cpu_count() if threads is None else threads
+        conf.device_count['CPU'] = num
+        conf.intra_op_parallelism_threads = max(threads // num, 1)
+        conf.inter_op_parallelism_threads = num
+    return conf
+
+
+def merge_grads(tower_grads, rows_touched=None):
+    """
+    合并各个塔的梯度。
+    :param tower_grads:  每个塔的 [(grad, var), ...]
+    :param rows_touched: 传入一个dict时，把每个稀疏梯度的变量本步实际更新的行数（去重后）记录进去
+    :return: [(grad, var), ...]，梯度为 None（变量与损失无关）的跳过。
+             稠密梯度取各塔的平均；IndexedSlices（例如 embedding_lookup 的梯度）先把各塔的 indices/values 拼接起来，
+             再把重复的行按行号求和合并成一行，同样除以塔的数量，与稠密梯度取平均的尺度一致。
+             这样优化器（例如Adam的稀疏更新）对每个字只处理一次，而不是每个塔、每次出现都处理一次
+    """
+    grads = {}
+    indexed_grads = {}
+    for grad in tower_grads:
+        for g, v in grad:
+            if g is None:
+                continue
+            if isinstance(g, tf.IndexedSlices):
+                if v not in indexed_grads:
+                    indexed_grads[v] = []
+                indexed_grads[v].append(g)
+            else:
+                if v not in grads:
+                    grads[v] = []
+                grads[v].append(g)
+    result = [(tf.reduce_mean(grads[v], axis=0), v) for v in grads]
+    for v in indexed_grads:
+        indices = tf.concat([g.indices for g in indexed_grads[v]], axis=0)
+        values = tf.concat([g.values for g in indexed_grads[v]], axis=0)
+        unique_indices, positions = tf.unique(indices)
+        values = tf.unsorted_segment_sum(values, positions, tf.shape(unique_indices)[0])
+        values = values / len(indexed_grads[v])
+        g = tf.IndexedSlices(values, unique_indices, indexed_grads[v][0].dense_shape)
+        result.append((g, v))
+        if rows_touched is not None:
+            rows_touched[v] = tf.size(unique_indices)
+    return result
+
+
+class Towers:
+    def __init__(self, devices, create, scope):
+        """
+        :param devices: 设备名的列表，见 get_devices
+        :param create:  create(device) 在给定设备上建立一个塔并返回它，第二个塔开始变量都是复用的
+        :param scope:   变量的 variable_scope
+        """
+        self.devices = devices
+        self.towers = []
+        # 稀疏梯度的变量 -> 本步更新的行数，见 merge_grads
+        self.rows_touched = {}
+        with tf.variable_scope(scope):
+            for device in devices:
+                self.towers.append(create(device))
+                tf.get_variable_scope().reuse_variables()
+
+    def merge_grads(self, func=lambda tower: tower.grad):
+        """
+        :param func: 从一个塔中取出它的 [(grad, var), ...]，默认是 tower.grad
+        """
+        with tf.device(self.devices[0]):
+            return merge_grads([func(tower) for tower in self.towers], self.rows_touched)
+
+    def total_rows_touched(self):
+        """
+        所有稀疏梯度本步更新的行数之和（标量张量），没有稀疏梯度时为0
+        """
+        with tf.device(self.devices[0]):
+            if not self.rows_touched:
+                return tf.constant(0)
+            return tf.add_n(list(self.rows_touched.values()))
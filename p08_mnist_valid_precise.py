@@ -2,6 +2,7 @@ import tensorflow as tf
 import argparse
 # import cv2
 from tensorflow.examples.tutorials.mnist.input_data import read_data_sets
+import summary_writer
 
 #tensorboard --logdir logs --port 6789
 class Config:
@@ -17,6 +18,8 @@ class Config:
         self.save_path = './models/{name}/{name}'.format(name = self.name)
         self.sample_path = './data/MNIST_data'
         self.logdir = './logs/{name}'.format(name = self.name)
+        # 每隔多少步写一次 summary，见 summary_writer.py
+        self.summary_every = 10
 
     def from_cmd_line(self):
         attrs_dict = self._get_attrs()
@@ -112,7 +115,7 @@ class Mnist:
             conf.allow_soft_placement = True
             self.session = tf.Session(graph=graph, config = conf)
             self.saver = tf.train.Saver()
-            self.file_writer = tf.summary.FileWriter(config.logdir, graph = graph)
+            self.file_writer = summary_writer.SummaryWriter(config.logdir, graph, self.tensors.summary_op, config.summary_every)
             try:
                 self.saver.restore(self.session, config.save_path)
                 print('resotr the model successfully!')
@@ -132,8 +135,7 @@ class Mnist:
                     self.tensors.y: y,
                     self.tensors.lr: self.config.lr
                 }
-                _, lo, su = self.session.run([self.tensors.train_op, self.tensors.loss, self.tensors.summary_op], feed_dict=feed_dic)
-                self.file_writer.add_summary(su, epoch * batches + batch)
+                _, lo = self.file_writer.run(self.session, [self.tensors.train_op, self.tensors.loss], feed_dic, epoch * batches + batch)
 
                 x, y = self.samples.next_valid(self.config.batch_size)
                 feed_dic = {
@@ -159,6 +161,7 @@ class Mnist:
             print('the predicted value is %d, the true value is %d' % (y_digit[i], y[i]))
         print('the test precise is %f' % (precise))
     def close(self):
+        self.file_writer.close()
         self.session.close()
 
 
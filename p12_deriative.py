@@ -1,3 +1,6 @@
+import numpy as np
+import p13_auto_derivative as auto
+
 
 a = 1.2
 b = 3.4
@@ -26,3 +29,23 @@ for _ in range(3000):
 print(x1)
 print(x2)
 
+
+
+
+# 用 p13 的 jacobian/hessian 做牛顿法：符号求导只在第一次执行，之后每一步都命中LRU缓存
+
+def newton(y, variables, x0, epoches = 20):
+    names = [v.name for v in variables]
+    x0 = np.array(x0, dtype=np.float64)
+    for _ in range(epoches):
+        env = dict(zip(names, x0))
+        g = np.array([d.eval(**env) for d in auto.jacobian([y], variables)[0]])
+        h = np.array([[d.eval(**env) for d in row] for row in auto.hessian(y, variables)])
+        x0 = x0 - np.linalg.lstsq(h, g, rcond=None)[0]
+    return x0
+
+v1 = auto.Variable('x1')
+v2 = auto.Variable('x2')
+y = (v1 - a) * (v1 - a) * (v2 - b) * (v2 - b)
+print(newton(y, [v1, v2], [1.4, 3]))
+print(auto.deriv_cache_info())
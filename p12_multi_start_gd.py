@@ -0,0 +1,118 @@
+import time
+import numpy as np
+import p13_auto_derivative as auto
+
+
+"""
+多起点的批量梯度下降：成千上万个起点放在一个 [n, d] 的数组里同时迭代，
+每个起点在梯度的范数小于 tol 时单独停止，记录它收敛用了多少次迭代。
+用来快速扫描 p11/p12 这类函数的损失曲面，代替逐个起点的标量Python循环。
+"""
+
+
+def multi_start_gd(grad, starts, lr=0.01, tol=1e-6, max_iters=10000):
+    """
+    :param grad:      grad(x) 对形状为 [m, d] 的一组点返回同样形状的梯度
+    :param starts:    起点，形状为 [n, d]；一维数组表示 n 个一元函数的起点
+    :return: (终点 [n, d], 每个起点的迭代次数 [n], 是否收敛 [n])
+             没有收敛的起点迭代次数为 max_iters
+    注意：各个分量同时更新；p12_deriative.py 的标量循环是先更新x1、再用新的x1更新x2，轨迹会略有不同
+    """
+    x = np.array(starts, dtype=np.float64)
+    if x.ndim == 1:
+        x = x[:, None]
+    n = len(x)
+    iterations = np.full(n, max_iters)
+
+    # 只对还没有收敛的起点计算，有起点收敛时才把它们移出工作数组
+    ids = np.arange(n)
+    active = x.copy()
+    for it in range(max_iters):
+        g = grad(active)
+        norm = np.sqrt(np.einsum('ij,ij->i', g, g))
+        done = norm < tol
+        if done.any():
+            x[ids[done]] = active[done]
+            iterations[ids[done]] = it
+            keep = ~done
+            ids, active, g = ids[keep], active[keep], g[keep]
+            if len(ids) == 0:
+                break
+        active -= lr * g
+    x[ids] = active
+    return x, iterations, iterations < max_iters
+
+
+def grad_from_exp(exp, variables):
+    """
+    用 p13 把表达式编译成带梯度的函数，包装成 multi_start_gd 需要的 grad(x)
+    """
+    names = [v.name if isinstance(v, auto.Variable) else v for v in variables]
+    value_grad = exp.compile(names, grad=True)
+
+    def grad(x):
+        _, gs = value_grad(*x.T)
+        return np.stack([np.broadcast_to(g, len(x)) for g in gs], axis=1)
+    return grad
+
+
+# p11_drievative1.py: f(x) = (x - 2)^2 + 100
+def grad_p11(x):
+    return 2 * (x - 2)
+
+
+# p12_deriative.py: f(x1, x2) = (x1 - a)^2 * (x2 - b)^2
+a = 1.2
+b = 3.4
+
+
+def grad_p12(x):
+    d1, d2 = x[:, 0] - a, x[:, 1] - b
+    return np.stack([2 * d1 * d2 ** 2, d1 ** 2 * 2 * d2], axis=1)
+
+
+def scalar_p12(x1, x2, lr=0.01, iters=3000):
+    """
+    p12_deriative.py 中的标量循环，作为耗时对照
+    """
+    for _ in range(iters):
+        x1 -= lr * 2 * (x1 - a) * (x2 - b) ** 2
+        x2 -= lr * (x1 - a) ** 2 * 2 * (x2 - b)
+    return x1, x2
+
+
+def report(name, cost, x, iterations, converged):
+    print('%-12s %d 个起点，耗时 %.3fs，收敛 %.1f%%，迭代次数 最少 %d / 中位数 %d / 最多 %d'
+          % (name, len(x), cost, converged.mean() * 100, iterations.min(), np.median(iterations), iterations.max()))
+
+
+if __name__ == '__main__':
+    n = 10000
+    np.random.seed(0)
+
+    starts = np.random.uniform(-10, 10, n)
+    start = time.perf_counter()
+    x, iterations, converged = multi_start_gd(grad_p11, starts, lr=0.01, tol=1e-6, max_iters=10000)
+    report('p11', time.perf_counter() - start, x, iterations, converged)
+    print('终点范围：', x.min(), x.max())
+
+    starts = np.stack([np.random.uniform(0, 2.5, n), np.random.uniform(2, 5, n)], axis=1)
+    start = time.perf_counter()
+    x, iterations, converged = multi_start_gd(grad_p12, starts, lr=0.01, tol=1e-4, max_iters=3000)
+    report('p12', time.perf_counter() - start, x, iterations, converged)
+
+    v1 = auto.Variable('x1')
+    v2 = auto.Variable('x2')
+    y = (v1 - a) * (v1 - a) * (v2 - b) * (v2 - b)
+    start = time.perf_counter()
+    x2, iterations2, converged2 = multi_start_gd(grad_from_exp(y, [v1, v2]), starts, lr=0.01, tol=1e-4,
+                                                 max_iters=3000)
+    report('p12 (p13)', time.perf_counter() - start, x2, iterations2, converged2)
+    print('与手写梯度的终点最大差异：', np.abs(x - x2).max())
+
+    m = 20
+    start = time.perf_counter()
+    for x1, x2 in starts[:m]:
+        scalar_p12(x1, x2)
+    print('标量循环：%d 个起点耗时 %.3fs，估计 %d 个起点需要 %.1fs'
+          % (m, time.perf_counter() - start, n, (time.perf_counter() - start) / m * n))
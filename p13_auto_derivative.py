@@ -1,45 +1,216 @@
+import functools
 import math
+import threading
+import weakref
+import numpy as np
+
+# 哈希共享（hash-consing）表：结构相同的子树只保留一个节点
+_interned = weakref.WeakValueDictionary()
+_intern_lock = threading.Lock()
+
 
 class Exp:
-    def eval(self, **env):
-        pass
+    # 让 ndarray * exp 之类的运算交给Exp的反向运算符处理，而不是被numpy逐元素展开
+    __array_ufunc__ = None
+
+    def __new__(cls, *args, **kwargs):
+        """
+        结构相同的节点（同类型、同子节点、同取值）直接返回已有的实例，
+        所以表达式是一个DAG，相同的子表达式只求值一次
+        """
+        key = _intern_key(cls, args, kwargs)
+        if key is None:
+            return super().__new__(cls)
+        with _intern_lock:
+            node = _interned.get(key)
+            if node is None:
+                node = super().__new__(cls)
+                # __init__只做赋值，先在锁内初始化，避免其他线程拿到半初始化的节点
+                node.__init__(*args, **kwargs)
+                node._initialized = True
+                _interned[key] = node
+        return node
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Python在__new__返回后还会再调用一次__init__；已经共享的节点跳过这次调用，
+        否则会用新的参数覆盖其他表达式正在使用的节点
+        """
+        super().__init_subclass__(**kwargs)
+        init = cls.__dict__.get('__init__')
+        if init is None:
+            return
+
+        @functools.wraps(init)
+        def __init__(self, *args, **kwargs):
+            if '_initialized' in self.__dict__:
+                return
+            init(self, *args, **kwargs)
+        cls.__init__ = __init__
 
-    def deriv(self, x):
+    def eval(self, **env):
+        """
+        env中的取值可以是标量，也可以是NumPy数组：数组模式下每个节点只执行一次向量化运算。
+        每个不同的节点在一次调用中只求值一次。
+        """
+        return _forward(self._plan(), env)[-1]
+
+    def deriv(self, x, simplify=False):
+        """
+        按拓扑序由子节点的导数构造本节点的导数，共享的子表达式只求导一次
+        :param simplify: 为True时对结果做常量折叠、消去0和1、合并同类项
+        """
         if not isinstance(x, Variable):
             raise Exception('cannot get derivative by a none variable!')
+        derivs = []
+        for node, indexes in self._plan():
+            derivs.append(node._deriv(x, [derivs[i] for i in indexes]))
+        result = derivs[-1]
+        return _simplify(result) if simplify else result
+
+    def _deriv(self, x, derivs):
+        """
+        已知子节点的导数derivs，构造本节点对x的导数
+        """
+        raise Exception('%s cannot be derived' % type(self).__name__)
+
+    def _simplify(self, args):
+        """
+        已知化简后的子节点args，返回化简后的本节点；默认只在子节点变化时重建
+        """
+        if all(a is c for a, c in zip(args, self.children())):
+            return self
+        return type(self)(*args)
+
+    def _topo(self):
+        """
+        缓存本节点的拓扑序；节点本身不可变，所以缓存永远有效
+        """
+        order = self.__dict__.get('_order')
+        if order is None:
+            order = topo_sort(self)
+            self._order = order
+        return order
+
+    def _plan(self):
+        """
+        拓扑序加上每个节点的子节点在拓扑序中的下标，
+        求值/求导时只用显式的列表下标，不递归，也不用按id查字典
+        """
+        plan = self.__dict__.get('_plan_cache')
+        if plan is None:
+            order = self._topo()
+            index = {id(node): i for i, node in enumerate(order)}
+            plan = [(node, [index[id(c)] for c in node.children()]) for node in order]
+            self._plan_cache = plan
+        return plan
+
+    def _repr_parts(self):
+        """
+        输出时的片段列表：字符串原样输出，Exp继续展开
+        """
+        return [type(self).__name__]
+
+    def __repr__(self):
+        """
+        用显式栈展开，很深的表达式也不会超过递归深度
+        """
+        result = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                result.append(item)
+            else:
+                stack.extend(reversed(item._repr_parts()))
+        return ''.join(result)
+
+    def children(self):
+        """
+        返回直接子节点，叶子节点返回空元组
+        """
+        return ()
+
+    def _apply(self, args, env):
+        """
+        已知子节点的值args，计算本节点的值（供grad的正向扫描使用）
+        """
+        raise Exception('%s cannot be applied' % type(self).__name__)
+
+    def _partials(self, args, result):
+        """
+        本节点对每个子节点的局部偏导数，与children()一一对应（逐元素）
+        """
+        return ()
+
+    def _backward(self, args, result, adjoint):
+        """
+        反向传播：由本节点的伴随值求每个子节点的伴随值，并按广播规则还原成子节点的形状。
+        矩阵乘法、求和等非逐元素的节点需要重写
+        """
+        return [_unbroadcast(adjoint * p, a) for p, a in zip(self._partials(args, result), args)]
+
+    def _tangent(self, args, result, dots):
+        """
+        正向传播：由子节点的导数dots求本节点的导数，非逐元素的节点需要重写
+        """
+        dot = 0
+        for p, d in zip(self._partials(args, result), dots):
+            dot = dot + p * d
+        return dot
+
+    def _code(self, names):
+        """
+        生成本节点的Python表达式源码，names为子节点结果的变量名
+        """
+        raise Exception('%s cannot be compiled' % type(self).__name__)
+
+    def _partials_code(self, names, result):
+        """
+        与_partials对应的源码版本，返回每个子节点局部偏导数的表达式，result为本节点结果的变量名
+        """
+        raise Exception('%s cannot be compiled with grad' % type(self).__name__)
+
+    def compile(self, args, grad=False):
+        """
+        把表达式编译成一个扁平的Python函数，参数顺序与args一致。
+        grad=True时函数返回 (value, [对args中每个变量的偏导数])。
+        注意：编译后的除法直接使用 /，除零时抛出Python自身的异常。
+        """
+        return compile_exp(self, args, grad)
 
     def __add__(self, other):
         other = to_exp(other)
-        return Add(self, other)
+        return _build(Add, self, other)
 
     def __radd__(self, other):
         other = to_exp(other)
-        return Add(other, self)
+        return _build(Add, other, self)
 
 
     def __sub__(self, other):
         other = to_exp(other)
-        return Sub(self, other)
+        return _build(Sub, self, other)
 
     def __rsub__(self, other):
         other = to_exp(other)
-        return Sub(other, self)
+        return _build(Sub, other, self)
 
     def __mul__(self, other):
         other = to_exp(other)
-        return Mul(self, other)
+        return _build(Mul, self, other)
 
     def __rmul__(self, other):
         other = to_exp(other)
-        return Mul(other, self)
+        return _build(Mul, other, self)
 
     def __truediv__(self, other):
         other = to_exp(other)
-        return Truediv(self, other)
+        return _build(Truediv, self, other)
 
     def __rtruediv__(self, other):
         other = to_exp(other)
-        return Truediv(other, self)
+        return _build(Truediv, other, self)
 
     def __abs__(self):
         return Abs(self)
@@ -54,46 +225,153 @@ class Exp:
         other = to_exp(other)
         return Cos(other)
 
+    def __matmul__(self, other):
+        other = to_exp(other)
+        return MatMul(self, other)
+
+    def __rmatmul__(self, other):
+        other = to_exp(other)
+        return MatMul(other, self)
+
+    def __pow__(self, other):
+        other = to_exp(other)
+        return _build(Pow, self, other)
+
+    def __rpow__(self, other):
+        other = to_exp(other)
+        return _build(Pow, other, self)
+
+    def __neg__(self):
+        return -1 * self
+
+    @staticmethod
+    def exp(other):
+        other = to_exp(other)
+        return Exponential(other)
+
+    @staticmethod
+    def log(other):
+        other = to_exp(other)
+        return Log(other)
+
+    @staticmethod
+    def sigmoid(other):
+        other = to_exp(other)
+        return Sigmoid(other)
+
+    @staticmethod
+    def sum(other, axis=None):
+        other = to_exp(other)
+        return Sum(other, axis)
+
+    @staticmethod
+    def mean(other, axis=None):
+        other = to_exp(other)
+        return Mean(other, axis)
+
 
 class Sin(Exp):
     def __init__(self, value):
         self.value = value
 
-    def eval(self, **env):
-        return math.sin(self.value.eval(**env))
+    def children(self):
+        return (self.value,)
 
-    def deriv(self, x):
-        return Cos(self.value)*self.value.deriv(x)
+    def _apply(self, args, env):
+        return _sin(args[0])
 
-    def __repr__(self):
-        return 'sin(%s)' % self.value
+    def _partials(self, args, result):
+        return (_cos(args[0]),)
+
+    def _code(self, names):
+        return '_sin(%s)' % names[0]
+
+    def _partials_code(self, names, result):
+        return ('_cos(%s)' % names[0],)
+
+    def _deriv(self, x, derivs):
+        return Cos(self.value) * derivs[0]
+
+    def _repr_parts(self):
+        return ['sin(', self.value, ')']
 
 class Cos(Exp):
     def __init__(self, value):
         self.value = value
 
-    def eval(self, **env):
-        return math.cos(self.value.eval(**env))
+    def children(self):
+        return (self.value,)
 
-    def deriv(self, x):
-        return -1 *Sin(self.value) * self.value.deriv(x)
+    def _apply(self, args, env):
+        return _cos(args[0])
 
-    def __repr__(self):
-        return 'cos(%s)' % self.value
+    def _partials(self, args, result):
+        return (-_sin(args[0]),)
+
+    def _code(self, names):
+        return '_cos(%s)' % names[0]
+
+    def _partials_code(self, names, result):
+        return ('-_sin(%s)' % names[0],)
+
+    def _deriv(self, x, derivs):
+        return -1 * Sin(self.value) * derivs[0]
+
+    def _repr_parts(self):
+        return ['cos(', self.value, ')']
 
 class Abs(Exp):
     def __init__(self,value):
         self.value = value
 
-    def eval(self, **env):
-        self.result = self.value.eval(**env)
-        return abs(self.result)
+    def children(self):
+        return (self.value,)
 
-    def deriv(self, x):
-        return (1 if self.result > 0 else -1) * self.value.deriv(x)
+    def _apply(self, args, env):
+        return abs(args[0])
 
-    def __repr__(self):
-        return '|%s|' % self.value
+    def _partials(self, args, result):
+        return (_sign(args[0]),)
+
+    def _code(self, names):
+        return 'abs(%s)' % names[0]
+
+    def _partials_code(self, names, result):
+        return ('_sign(%s)' % names[0],)
+
+    def _deriv(self, x, derivs):
+        return Sign(self.value) * derivs[0]
+
+    def _repr_parts(self):
+        return ['|', self.value, '|']
+
+class Sign(Exp):
+    """
+    |x|的导数：x>0时为1，否则为-1。用一个节点表示，这样Abs求导不需要依赖上一次求值的结果
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def children(self):
+        return (self.value,)
+
+    def _apply(self, args, env):
+        return _sign(args[0])
+
+    def _partials(self, args, result):
+        return (0,)
+
+    def _code(self, names):
+        return '_sign(%s)' % names[0]
+
+    def _partials_code(self, names, result):
+        return ('0',)
+
+    def _deriv(self, x, derivs):
+        return Const(0)
+
+    def _repr_parts(self):
+        return ['sign(', self.value, ')']
 
 
 
@@ -106,21 +384,40 @@ class Truediv(Exp):
         self.left = left
         self.right = right
 
-    def eval(self, **env):
-        if self.right.eval(**env) == 0:
-            raise Exception('divided by zero!')
+    def children(self):
+        return (self.left, self.right)
 
-        if self.left.eval(**env) == 0:
-            return 0
-        return self.left.eval(**env) / self.right.eval(**env)
+    def _apply(self, args, env):
+        _check_divisor(args[1])
+        return args[0] / args[1]
 
-    def deriv(self, x):
-        if isinstance(self.right, Const) and self.right.eval() == 0:
-            raise Exception('divided by zero!')
-        return (self.left.deriv(x) * self.right - self.left * self.right.deriv(x)) / (self.right * self.right)
+    def _partials(self, args, result):
+        return (1 / args[1], -args[0] / (args[1] * args[1]))
 
-    def __repr__(self):
-        return '(%s / %s)' % (self.left, self.right)
+    def _code(self, names):
+        return '%s / %s' % (names[0], names[1])
+
+    def _partials_code(self, names, result):
+        return ('1 / %s' % names[1], '-%s / (%s * %s)' % (names[0], names[1], names[1]))
+
+    def _simplify(self, args):
+        lifted = _lift_broadcast(Truediv, args)
+        if lifted is not None:
+            return lifted
+        left, right = args
+        if _is_const(left, 0):
+            return _keep_shape(left, right)
+        if _is_const(right, 1):
+            return left
+        return super()._simplify(args)
+
+    def _deriv(self, x, derivs):
+        if isinstance(self.right, Const):
+            _check_divisor(self.right.value)
+        return (derivs[0] * self.right - self.left * derivs[1]) / (self.right * self.right)
+
+    def _repr_parts(self):
+        return ['(', self.left, ' / ', self.right, ')']
 
 
 class Mul(Exp):
@@ -128,45 +425,642 @@ class Mul(Exp):
         self.left = left
         self.right = right
 
-    def eval(self, **env):
-        return self.left.eval(**env) * self.right.eval(**env)
-
-    def deriv(self, x):
-        return self.left.deriv(x) * self.right + self.left * self.right.deriv(x)
-
-    def __repr__(self):
-        return '(%s * %s)' % (self.left, self.right)
+    def children(self):
+        return (self.left, self.right)
+
+    def _apply(self, args, env):
+        return args[0] * args[1]
+
+    def _partials(self, args, result):
+        return (args[1], args[0])
+
+    def _code(self, names):
+        return '%s * %s' % (names[0], names[1])
+
+    def _partials_code(self, names, result):
+        return (names[1], names[0])
+
+    def _simplify(self, args):
+        lifted = _lift_broadcast(Mul, args)
+        if lifted is not None:
+            return lifted
+        left, right = args
+        # 乘0折叠成标量0会丢掉另一边的形状，见_keep_shape
+        if _is_const(left, 0):
+            return _keep_shape(left, right)
+        if _is_const(right, 0):
+            return _keep_shape(right, left)
+        if _is_const(right) and not _is_const(left):
+            left, right = right, left
+        if _is_const(left) and isinstance(right, Mul) and _is_const(right.left):
+            left, right = Const(left.value * right.left.value), right.right
+        if _is_const(left, 1):
+            return right
+        return Mul(left, right)
+
+    def _deriv(self, x, derivs):
+        return derivs[0] * self.right + self.left * derivs[1]
+
+    def _repr_parts(self):
+        return ['(', self.left, ' * ', self.right, ')']
 
 class Sub(Exp):
     def __init__(self, left, right):
         self.left = left
         self.right = right
 
-    def eval(self, **env):
-        return self.left.eval(**env) - self.right.eval(**env)
+    def children(self):
+        return (self.left, self.right)
 
-    def deriv(self, x):
-        return self.left.deriv(x) - self.right.deriv(x)
+    def _apply(self, args, env):
+        return args[0] - args[1]
 
-    def __repr__(self):
-        return '(%s - %s)' % (self.left, self.right)
+    def _partials(self, args, result):
+        return (1, -1)
+
+    def _code(self, names):
+        return '%s - %s' % (names[0], names[1])
+
+    def _partials_code(self, names, result):
+        return ('1', '-1')
+
+    def _simplify(self, args):
+        return _merge_terms(_linear_terms(Sub(*args)))
+
+    def _deriv(self, x, derivs):
+        return derivs[0] - derivs[1]
+
+    def _repr_parts(self):
+        return ['(', self.left, ' - ', self.right, ')']
 
 class Add(Exp):
     def __init__(self, left, right):
         self.left = left
         self.right = right
 
-    def eval(self, **env):
-        return self.left.eval(**env) + self.right.eval(**env)
+    def children(self):
+        return (self.left, self.right)
 
-    def deriv(self, x):
-        return self.left.deriv(x) + self.right.deriv(x)
+    def _apply(self, args, env):
+        return args[0] + args[1]
 
-    def __repr__(self):
-        return '(%s + %s)' % (self.left, self.right)
+    def _partials(self, args, result):
+        return (1, 1)
+
+    def _code(self, names):
+        return '%s + %s' % (names[0], names[1])
+
+    def _partials_code(self, names, result):
+        return ('1', '1')
+
+    def _simplify(self, args):
+        return _merge_terms(_linear_terms(Add(*args)))
+
+    def _deriv(self, x, derivs):
+        return derivs[0] + derivs[1]
+
+    def _repr_parts(self):
+        return ['(', self.left, ' + ', self.right, ')']
+
+
+"""
+以下是张量（NumPy数组）节点：取值可以是任意形状的ndarray，支持广播，
+grad() 中按反向模式传播梯度，可以用来训练 p33/p34 中手写的神经网络
+"""
+
+class Exponential(Exp):
+    def __init__(self, value):
+        self.value = value
+
+    def children(self):
+        return (self.value,)
+
+    def _apply(self, args, env):
+        return np.exp(args[0])
+
+    def _partials(self, args, result):
+        return (result,)
+
+    def _code(self, names):
+        return '_np.exp(%s)' % names[0]
+
+    def _partials_code(self, names, result):
+        return (result,)
+
+    def _deriv(self, x, derivs):
+        return self * derivs[0]
+
+    def _repr_parts(self):
+        return ['exp(', self.value, ')']
+
+class Log(Exp):
+    def __init__(self, value):
+        self.value = value
 
+    def children(self):
+        return (self.value,)
 
+    def _apply(self, args, env):
+        return np.log(args[0])
 
+    def _partials(self, args, result):
+        return (_reciprocal(args[0]),)
+
+    def _code(self, names):
+        return '_np.log(%s)' % names[0]
+
+    def _partials_code(self, names, result):
+        return ('_reciprocal(%s)' % names[0],)
+
+    def _deriv(self, x, derivs):
+        return derivs[0] / self.value
+
+    def _repr_parts(self):
+        return ['log(', self.value, ')']
+
+class Sigmoid(Exp):
+    def __init__(self, value):
+        self.value = value
+
+    def children(self):
+        return (self.value,)
+
+    def _apply(self, args, env):
+        return 1 / (1 + np.exp(-args[0]))
+
+    def _partials(self, args, result):
+        return (result * (1 - result),)
+
+    def _code(self, names):
+        return '1 / (1 + _np.exp(-%s))' % names[0]
+
+    def _partials_code(self, names, result):
+        return ('%s * (1 - %s)' % (result, result),)
+
+    def _deriv(self, x, derivs):
+        return self * (1 - self) * derivs[0]
+
+    def _repr_parts(self):
+        return ['sigmoid(', self.value, ')']
+
+class Pow(Exp):
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def children(self):
+        return (self.left, self.right)
+
+    def _apply(self, args, env):
+        return _pow(args[0], args[1])
+
+    def _partials(self, args, result):
+        return (_pow_dbase(args[0], args[1]), result * _pow_log(args[0]))
+
+    def _code(self, names):
+        return '_pow(%s, %s)' % (names[0], names[1])
+
+    def _partials_code(self, names, result):
+        return ('_pow_dbase(%s, %s)' % (names[0], names[1]), '%s * _pow_log(%s)' % (result, names[0]))
+
+    def _simplify(self, args):
+        if _is_const(args[1], 1):
+            return args[0]
+        if _is_const(args[1], 0):
+            return _keep_shape(Const(1), args[0])
+        return super()._simplify(args)
+
+    def _deriv(self, x, derivs):
+        if isinstance(self.right, Const):
+            return self.right * self.left ** (self.right - 1) * derivs[0]
+        return self * (derivs[1] * Log(self.left) + self.right * derivs[0] / self.left)
+
+    def _repr_parts(self):
+        return ['(', self.left, ' ** ', self.right, ')']
+
+class MatMul(Exp):
+    """
+    矩阵乘法（二维矩阵，或其中一边是一维向量）
+    """
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def children(self):
+        return (self.left, self.right)
+
+    def _apply(self, args, env):
+        return np.matmul(args[0], args[1])
+
+    def _backward(self, args, result, adjoint):
+        # 一维向量先补成矩阵（与np.matmul的规则一致），算完再还原形状
+        a, b = np.asarray(args[0]), np.asarray(args[1])
+        adjoint = np.broadcast_to(adjoint, np.shape(result))
+        a2, b2 = a, b
+        if a.ndim == 1:
+            a2, adjoint = a[None, :], adjoint[None]
+        if b.ndim == 1:
+            b2, adjoint = b[:, None], adjoint[..., None]
+        da = np.matmul(adjoint, b2.T).reshape(a.shape)
+        db = np.matmul(a2.T, adjoint).reshape(b.shape)
+        return da, db
+
+    def _tangent(self, args, result, dots):
+        # 与x无关的一边导数是标量0，去掉这一项；其余标量导数（例如变量对自身的导数1）广播成该边的形状
+        dot = 0
+        if not _is_zero(dots[0]):
+            dot = dot + np.matmul(np.broadcast_to(dots[0], np.shape(args[0])), args[1])
+        if not _is_zero(dots[1]):
+            dot = dot + np.matmul(args[0], np.broadcast_to(dots[1], np.shape(args[1])))
+        return dot
+
+    def _code(self, names):
+        return '%s @ %s' % (names[0], names[1])
+
+    def _deriv(self, x, derivs):
+        terms = []
+        if not _is_const(derivs[0], 0):
+            terms.append(_broadcast_like(derivs[0], self.left) @ self.right)
+        if not _is_const(derivs[1], 0):
+            terms.append(self.left @ _broadcast_like(derivs[1], self.right))
+        if not terms:
+            return Const(0)
+        return terms[0] if len(terms) == 1 else terms[0] + terms[1]
+
+    def _repr_parts(self):
+        return ['(', self.left, ' @ ', self.right, ')']
+
+class Sum(Exp):
+    """
+    沿axis求和，axis为None时对所有元素求和
+    """
+    def __init__(self, value, axis=None):
+        self.value = value
+        self.axis = _normalize_axis(axis)
+
+    def children(self):
+        return (self.value,)
+
+    def _apply(self, args, env):
+        return np.sum(args[0], axis=self.axis)
+
+    def _backward(self, args, result, adjoint):
+        return (_expand_reduced(adjoint, args[0], self.axis),)
+
+    def _tangent(self, args, result, dots):
+        if _is_zero(dots[0]):
+            return 0
+        return np.sum(np.broadcast_to(dots[0], np.shape(args[0])), axis=self.axis)
+
+    def _code(self, names):
+        return '_np.sum(%s, axis=%r)' % (names[0], self.axis)
+
+    def _simplify(self, args):
+        return self if args[0] is self.value else Sum(args[0], self.axis)
+
+    def _deriv(self, x, derivs):
+        if _is_const(derivs[0], 0):
+            return Const(0)
+        return Sum(_broadcast_like(derivs[0], self.value), self.axis)
+
+    def _repr_parts(self):
+        return ['sum(', self.value, ', axis=%s)' % (self.axis,)]
+
+class Mean(Exp):
+    """
+    沿axis求平均，axis为None时对所有元素求平均
+    """
+    def __init__(self, value, axis=None):
+        self.value = value
+        self.axis = _normalize_axis(axis)
+
+    def children(self):
+        return (self.value,)
+
+    def _apply(self, args, env):
+        return np.mean(args[0], axis=self.axis)
+
+    def _backward(self, args, result, adjoint):
+        count = np.size(args[0]) / max(np.size(result), 1)
+        return (_expand_reduced(adjoint, args[0], self.axis) / count,)
+
+    def _tangent(self, args, result, dots):
+        if _is_zero(dots[0]):
+            return 0
+        return np.mean(np.broadcast_to(dots[0], np.shape(args[0])), axis=self.axis)
+
+    def _code(self, names):
+        return '_np.mean(%s, axis=%r)' % (names[0], self.axis)
+
+    def _simplify(self, args):
+        return self if args[0] is self.value else Mean(args[0], self.axis)
+
+    def _deriv(self, x, derivs):
+        if _is_const(derivs[0], 0):
+            return Const(0)
+        return Mean(_broadcast_like(derivs[0], self.value), self.axis)
+
+    def _repr_parts(self):
+        return ['mean(', self.value, ', axis=%s)' % (self.axis,)]
+
+class BroadcastLike(Exp):
+    """
+    把value广播成like的形状。变量对自身的导数是标量1、常量的导数是标量0，
+    矩阵乘法、按轴求和这些运算需要先把它们补成对应操作数的形状
+    """
+    def __init__(self, value, like):
+        self.value = value
+        self.like = like
+
+    def children(self):
+        return (self.value, self.like)
+
+    def _apply(self, args, env):
+        return args[0] + np.zeros_like(args[1])
+
+    def _partials(self, args, result):
+        return (1, 0)
+
+    def _code(self, names):
+        return '%s + _np.zeros_like(%s)' % (names[0], names[1])
+
+    def _partials_code(self, names, result):
+        return ('1', '0')
+
+    def _simplify(self, args):
+        if _shape_covered(args[1], args[0]):
+            return args[0]
+        return super()._simplify(args)
+
+    def _deriv(self, x, derivs):
+        return _broadcast_like(derivs[0], self.like)
+
+    def _repr_parts(self):
+        return ['broadcast(', self.value, ', ', self.like, ')']
+
+
+
+
+
+def _sin(value):
+    return np.sin(value) if isinstance(value, np.ndarray) else math.sin(value)
+
+
+def _cos(value):
+    return np.cos(value) if isinstance(value, np.ndarray) else math.cos(value)
+
+
+def _sign(value):
+    """
+    |x|的导数，x==0时沿用原来的约定取-1
+    """
+    if isinstance(value, np.ndarray):
+        return np.where(value > 0, 1, -1)
+    return 1 if value > 0 else -1
+
+
+def _reciprocal(value):
+    """
+    1 / value，value为0时得到inf而不是抛出ZeroDivisionError（log在0处的导数）
+    """
+    with np.errstate(divide='ignore'):
+        return np.divide(1.0, value)
+
+
+def _pow(a, b):
+    """
+    a ** b。负数的非整数次幂（Python会悄悄返回复数，NumPy返回nan）和0的负数次幂直接报错
+    """
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        negative = np.any((a < 0) & (b != np.round(b)))
+        zero = np.any((a == 0) & (b < 0))
+    else:
+        negative = a < 0 and b != round(b)
+        zero = a == 0 and b < 0
+    if negative:
+        raise Exception('cannot raise a negative number to a non-integer power!')
+    if zero:
+        raise Exception('divided by zero!')
+    return a ** b
+
+
+def _pow_dbase(a, b):
+    """
+    a ** b 对底数的偏导数 b * a ** (b - 1)。a=0、0<b<1 时（例如sqrt在0处）为inf，b=0时为0
+    """
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(b == 0, 0.0, b * np.power(a, b - 1.0))
+    if b == 0:
+        return 0
+    if a == 0 and b < 1:
+        return math.inf
+    return b * a ** (b - 1)
+
+
+def _pow_log(a):
+    """
+    a ** b 对指数的偏导数是 a ** b * ln(a)，只在 a>0 时有定义，其余位置取0
+    """
+    if isinstance(a, np.ndarray):
+        return np.log(np.where(a > 0, a, 1))
+    return math.log(a) if a > 0 else 0
+
+
+def _unbroadcast(grad, value):
+    """
+    把广播后的梯度按广播的轴求和，还原成value的形状。
+    value是Python标量时保持逐点的梯度（数组模式下每个点各自的导数），输出是标量时由grad最后再约简；
+    NumPy的数组和标量（如求和的结果）则按张量处理
+    """
+    if not isinstance(value, (np.ndarray, np.generic)):
+        return grad
+    shape = np.shape(value)
+    if np.shape(grad) == shape:
+        return grad
+    grad = np.asarray(grad)
+    if grad.ndim < len(shape):
+        return np.broadcast_to(grad, shape)
+    while grad.ndim > len(shape):
+        grad = grad.sum(axis=0)
+    for axis, size in enumerate(shape):
+        if size == 1 and grad.shape[axis] != 1:
+            grad = grad.sum(axis=axis, keepdims=True)
+    return np.broadcast_to(grad, shape)
+
+
+def _normalize_axis(axis):
+    """
+    axis统一成None、int或int的元组，列表不能直接交给np.sum，也不能作为共享的键
+    """
+    if axis is None:
+        return None
+    if isinstance(axis, (list, tuple)):
+        return tuple(int(a) for a in axis)
+    return int(axis)
+
+
+def _expand_reduced(adjoint, value, axis):
+    """
+    求和/平均的反向传播：把被约简掉的轴补回来，再广播成value的形状
+    """
+    if axis is not None:
+        adjoint = np.expand_dims(adjoint, axis)
+    return np.broadcast_to(adjoint, np.shape(value))
+
+
+def _intern_key(cls, args, kwargs=None):
+    """
+    子节点用id区分（子节点本身已被共享），常量按类型和值（浮点数还有符号）区分；数组常量不共享。
+    关键字参数按名字排序后加在后面，所以 Sum(x, 0) 与 Sum(x, axis=0) 是两个节点，但取值相同
+    """
+    key = [cls]
+    items = list(args)
+    for name in sorted(kwargs or ()):
+        items.append(('=', name))
+        items.append(kwargs[name])
+    for a in items:
+        if isinstance(a, Exp):
+            key.append(id(a))
+        elif isinstance(a, np.ndarray):
+            return None
+        elif isinstance(a, list):
+            key.append((tuple, tuple(a)))
+        elif isinstance(a, (float, np.floating)):
+            # 0.0 == -0.0，但两者的符号不同（例如 1 / -0.0），要区分开
+            key.append((type(a), a, math.copysign(1, a)))
+        else:
+            key.append((type(a), a))
+    return tuple(key)
+
+
+def _is_const(exp, value=None):
+    """
+    exp是否为标量常量（value不为None时还要求取值相等）
+    """
+    if not isinstance(exp, Const) or isinstance(exp.value, np.ndarray):
+        return False
+    return value is None or exp.value == value
+
+
+def _is_tensor(exp):
+    """
+    exp中是否有改变形状的运算（矩阵乘法、求和、平均）或数组常量，这样的表达式取值的形状不能靠广播还原。
+    结果缓存在节点上，与_simplify一样用显式栈自底向上计算
+    """
+    stack = [exp]
+    while stack:
+        node = stack[-1]
+        if '_tensor' in node.__dict__:
+            stack.pop()
+            continue
+        pending = [c for c in node.children() if '_tensor' not in c.__dict__]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        node._tensor = (isinstance(node, (MatMul, Sum, Mean, BroadcastLike))
+                        or (isinstance(node, Const) and isinstance(node.value, np.ndarray))
+                        or any(c._tensor for c in node.children()))
+    return exp._tensor
+
+
+def _leaves(exp):
+    """
+    逐元素的表达式（没有矩阵乘法、求和、平均和数组常量）中出现的变量名集合，它的形状就是这些变量广播后的形状；
+    不是逐元素的表达式返回None。结果缓存在节点上，与_is_tensor一样用显式栈计算
+    """
+    stack = [exp]
+    while stack:
+        node = stack[-1]
+        if '_leaf_names' in node.__dict__:
+            stack.pop()
+            continue
+        pending = [c for c in node.children() if '_leaf_names' not in c.__dict__]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        sets = [c._leaf_names for c in node.children()]
+        if isinstance(node, (MatMul, Sum, Mean)) or any(names is None for names in sets):
+            names = None
+        elif isinstance(node, Variable):
+            names = frozenset([node.name])
+        elif isinstance(node, Const):
+            names = None if isinstance(node.value, np.ndarray) else frozenset()
+        else:
+            # 长链上子节点的集合通常相同，直接复用最大的那个，不重复创建
+            names = max(sets, key=len, default=frozenset())
+            if not all(other <= names for other in sets):
+                names = names.union(*sets)
+        node._leaf_names = names
+    return exp._leaf_names
+
+
+def _shape_covered(dropped, result):
+    """
+    确定 dropped 的形状广播后不会超出 result 的形状时返回True：
+    dropped 是标量表达式，或者两者都是逐元素的表达式且 dropped 的变量都出现在 result 中
+    """
+    if dropped is result:
+        return True
+    names = _leaves(dropped)
+    if names is None:
+        return False
+    if not names:
+        return True
+    others = _leaves(result)
+    return others is not None and names <= others
+
+
+def _keep_shape(result, dropped):
+    """
+    化简时去掉了子表达式dropped（乘0、0除以x、x**0、同类项相消），取值不变，但形状可能变小，
+    例如 sum(X @ W - X @ W + 1) 中的 X @ W - X @ W + 1 只剩下标量1。
+    不能确定形状不变时用BroadcastLike把result广播成dropped的形状
+    """
+    if _shape_covered(dropped, result):
+        return result
+    return BroadcastLike(result, dropped)
+
+
+def _lift_broadcast(cls, args):
+    """
+    逐元素的二元运算中有一边是BroadcastLike时，先对它的value做运算并化简，再把形状补回去。
+    BroadcastLike因此总在外层，外层的加减法合并同类项时能把已经被其他项覆盖的形状去掉
+    """
+    likes = []
+    values = []
+    for a in args:
+        while isinstance(a, BroadcastLike):
+            likes.append(a.like)
+            a = a.value
+        values.append(a)
+    if not likes:
+        return None
+    result = _simplify_node(cls(*values), values)
+    for like in likes:
+        result = _keep_shape(result, like)
+    return result
+
+
+def _is_zero(value):
+    """
+    正向模式中与x无关的节点，导数是标量0
+    """
+    return np.ndim(value) == 0 and value == 0
+
+
+def _broadcast_like(deriv, exp):
+    """
+    deriv可能是标量（逐元素的表达式）时，把它广播成exp的形状
+    """
+    return deriv if _is_tensor(deriv) else BroadcastLike(deriv, exp)
+
+
+def _check_divisor(value):
+    if np.any(value == 0):
+        raise Exception('divided by zero!')
 
 
 def to_exp(other):
@@ -174,7 +1068,7 @@ def to_exp(other):
         return other
     if type(other) == str:
         return Variable(other)
-    if type(other) in (int, float):
+    if isinstance(other, (int, float, np.number, np.ndarray)):
         return Const(other)
     raise Exception('cannot convert %s to Exp' % other)
 
@@ -182,34 +1076,390 @@ class Variable(Exp):
     def __init__(self, name):
         self.name = name
 
-    def eval(self, **env):
+    def _apply(self, args, env):
         if self.name in env:
             return env[self.name]
         raise Exception('%s not found' % self.name)
 
-    def deriv(self, x):
-        super().deriv(x)
-        return 1 if x.name == self.name else 0
+    def eval(self, **env):
+        return self._apply((), env)
+
+    def _deriv(self, x, derivs):
+        return Const(1 if x.name == self.name else 0)
 
-    def __repr__(self):
-        return self.name
+    def _repr_parts(self):
+        return [self.name]
 
 class Const(Exp):
     def __init__(self,value):
         self.value = value
 
-    def eval(self, **env):
+    def _apply(self, args, env):
         return self.value
 
-    def deriv(self, x):
-        super().deriv(x)
-        return 0
-
-    def __repr__(self):
-        return str(self.value)
-
-
+    def eval(self, **env):
+        return self.value
 
+    def _partials_code(self, names, result):
+        return ()
+
+    def _deriv(self, x, derivs):
+        return Const(0)
+
+    def _repr_parts(self):
+        return [str(self.value)]
+
+
+
+def topo_sort(exp):
+    """
+    用显式栈做后序遍历，返回表达式中所有不同的节点（子节点总在父节点之前）
+    """
+    order = []
+    visited = set()
+    stack = [(exp, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            order.append(node)
+            continue
+        if id(node) in visited:
+            continue
+        visited.add(id(node))
+        stack.append((node, True))
+        for child in reversed(node.children()):
+            if id(child) not in visited:
+                stack.append((child, False))
+    return order
+
+
+def _forward(plan, env):
+    """
+    按拓扑序对每个节点求值一次，返回与拓扑序对应的取值列表
+    """
+    values = []
+    for node, indexes in plan:
+        values.append(node._apply([values[i] for i in indexes], env))
+    return values
+
+
+def count_nodes(exp):
+    """
+    DAG中不同节点的个数（共享的子表达式只算一次）
+    """
+    return len(to_exp(exp)._topo())
+
+
+def tree_size(exp):
+    """
+    把DAG展开成树后的节点个数，用于对比共享带来的节省
+    """
+    sizes = {}
+    for node in to_exp(exp)._topo():
+        sizes[id(node)] = 1 + sum(sizes[id(c)] for c in node.children())
+    return sizes[id(exp)]
+
+
+# 合并同类项时加减链最多展开的项数，避免超长链上的平方复杂度
+_MAX_TERMS = 32
+
+
+def _linear_terms(exp):
+    """
+    把加减链展开成 [(系数, 项)] 的列表，常数项的'项'为None
+    """
+    terms = []
+    stack = [(1, exp)]
+    while stack:
+        coef, node = stack.pop()
+        if isinstance(node, (Add, Sub)) and len(terms) + len(stack) < _MAX_TERMS:
+            stack.append((-coef if isinstance(node, Sub) else coef, node.right))
+            stack.append((coef, node.left))
+        elif _is_const(node):
+            terms.append((coef * node.value, None))
+        elif isinstance(node, Mul) and _is_const(node.left):
+            terms.append((coef * node.left.value, node.right))
+        elif isinstance(node, BroadcastLike):
+            # 化简时保留下来的形状（见_keep_shape）当作系数为0的项，合并时再决定是否还需要保留
+            terms.append((0, node.like))
+            stack.append((coef, node.value))
+        else:
+            terms.append((coef, node))
+    return terms
+
+
+def _merge_terms(terms):
+    """
+    合并系数相同的项（结构相同的项已被共享成同一个节点），再重新组装成加减链。
+    系数为0的项被去掉，但它们的形状要保留，见_keep_shape
+    """
+    const = 0
+    coefs = {}
+    dropped = []
+    for coef, term in terms:
+        if term is None:
+            const += coef
+        elif id(term) in coefs:
+            coefs[id(term)][0] += coef
+        else:
+            coefs[id(term)] = [coef, term]
+
+    result = None
+    for coef, term in coefs.values():
+        if coef == 0:
+            dropped.append(term)
+            continue
+        if result is None:
+            result = term if coef == 1 else Mul(Const(coef), term)
+        elif coef < 0:
+            result = Sub(result, term if coef == -1 else Mul(Const(-coef), term))
+        else:
+            result = Add(result, term if coef == 1 else Mul(Const(coef), term))
+    if result is None:
+        result = Const(const)
+    elif const > 0:
+        result = Add(result, Const(const))
+    elif const < 0:
+        result = Sub(result, Const(-const))
+    for term in dropped:
+        result = _keep_shape(result, term)
+    return result
+
+
+def _build(cls, left, right):
+    """
+    运算符重载使用：两边都是标量常量时直接折叠成常量
+    """
+    node = cls(left, right)
+    if _is_const(left) and _is_const(right):
+        return _simplify_node(node, [left, right])
+    return node
+
+
+def _simplify_node(node, args):
+    if not args:
+        return node
+    if all(isinstance(a, Const) for a in args):
+        # 除零等错误直接抛出，不能折叠成一个错误的常量
+        return Const(node._apply([a.value for a in args], {}))
+    return node._simplify(args)
+
+
+def _simplify(exp):
+    """
+    自底向上化简。节点不可变，化简结果缓存在节点上，已化简过的子表达式不再遍历
+    """
+    stack = [exp]
+    while stack:
+        node = stack[-1]
+        if '_simplified' in node.__dict__:
+            stack.pop()
+            continue
+        pending = [c for c in node.children() if '_simplified' not in c.__dict__]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        result = _simplify_node(node, [c._simplified for c in node.children()])
+        node._simplified = result
+        if '_simplified' not in result.__dict__:
+            result._simplified = result
+    return exp._simplified
+
+
+def simplify(exp):
+    """
+    常量折叠、消去乘0乘1、合并同类项，例如 (0 * x) + (1 * sin(x)) 化简为 sin(x)
+    """
+    return _simplify(to_exp(exp))
+
+
+def eval_with_grad(exp, wrt, **env):
+    """
+    正向模式（对偶数）求导：一次遍历中同时传递 (值, 对wrt的导数)，返回 (value, derivative)。
+    不修改任何节点，所以同一个表达式可以在多个线程中同时求值。
+    """
+    exp = to_exp(exp)
+    wrt = to_exp(wrt)
+    if not isinstance(wrt, Variable):
+        raise Exception('cannot get derivative by a none variable!')
+
+    values = []
+    dots = []
+    for node, indexes in exp._plan():
+        args = [values[i] for i in indexes]
+        value = node._apply(args, env)
+        if isinstance(node, Variable):
+            dot = 1 if node.name == wrt.name else 0
+        else:
+            dot = node._tangent(args, value, [dots[i] for i in indexes])
+        values.append(value)
+        dots.append(dot)
+    return values[-1], dots[-1]
+
+
+def grad(exp, variables, **env):
+    """
+    反向模式求导：一次正向扫描求值，一次反向扫描累加伴随值，
+    一次性返回exp对variables中每个变量的偏导数（顺序与variables一致）
+    :param exp: 表达式
+    :param variables: Variable或变量名的列表
+    :param env: 变量的取值
+    """
+    exp = to_exp(exp)
+    names = []
+    for v in variables:
+        v = to_exp(v)
+        if not isinstance(v, Variable):
+            raise Exception('cannot get derivative by a none variable!')
+        names.append(v.name)
+
+    plan = exp._plan()
+    values = _forward(plan, env)
+
+    adjoints = [None] * len(plan)
+    adjoints[-1] = 1
+    result = {}
+    for position in range(len(plan) - 1, -1, -1):
+        adjoint = adjoints[position]
+        if adjoint is None:
+            continue
+        node, indexes = plan[position]
+        if isinstance(node, Variable):
+            result[node.name] = result.get(node.name, 0) + adjoint
+            continue
+        args = [values[i] for i in indexes]
+        for i, contribution in zip(indexes, node._backward(args, values[position], adjoint)):
+            if isinstance(plan[i][0], Const):
+                continue
+            adjoints[i] = contribution if adjoints[i] is None else adjoints[i] + contribution
+
+    # 输出是标量（例如求和得到的损失）时，梯度按变量取值的形状约简，与正向模式一致；
+    # 只有输出本身是数组（数组模式逐点求值）时，Python标量变量才保留逐点的梯度
+    if np.ndim(values[-1]) == 0:
+        for name in result:
+            if np.ndim(env[name]) == 0 and np.ndim(result[name]) > 0:
+                result[name] = np.sum(result[name])
+    return [result.get(name, 0) for name in names]
+
+
+# 导数树的LRU缓存大小
+DERIV_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=DERIV_CACHE_SIZE)
+def _cached_deriv(exp, name, simplify):
+    return exp.deriv(Variable(name), simplify=simplify)
+
+
+def cached_deriv(exp, x, simplify=True):
+    """
+    带LRU缓存的deriv：以(表达式本身, 变量名)为键，结构相同的表达式已被共享成同一个节点，
+    所以优化循环里重复构造的表达式也能命中缓存
+    """
+    exp = to_exp(exp)
+    x = to_exp(x)
+    if not isinstance(x, Variable):
+        raise Exception('cannot get derivative by a none variable!')
+    return _cached_deriv(exp, x.name, simplify)
+
+
+def deriv_cache_info():
+    return _cached_deriv.cache_info()
+
+
+def jacobian(exps, variables, simplify=True):
+    """
+    雅可比矩阵：result[i][j] 是 exps[i] 对 variables[j] 的导数（表达式）
+    """
+    return [[cached_deriv(e, v, simplify) for v in variables] for e in exps]
+
+
+def hessian(exp, variables, simplify=True):
+    """
+    海森矩阵：result[i][j] 是 exp 对 variables[i]、variables[j] 的二阶导数（表达式），
+    利用对称性只求上三角
+    """
+    first = [cached_deriv(exp, v, simplify) for v in variables]
+    result = [[None] * len(variables) for _ in variables]
+    for i in range(len(variables)):
+        for j in range(i, len(variables)):
+            result[i][j] = result[j][i] = cached_deriv(first[i], variables[j], simplify)
+    return result
+
+
+def compile_exp(exp, args, grad=False):
+    """
+    按拓扑序生成直线型代码（每个节点一行赋值），用exec编译成函数，
+    避免eval时逐层的方法分派和**env打包
+    """
+    exp = to_exp(exp)
+    names = []
+    for a in args:
+        a = to_exp(a)
+        if not isinstance(a, Variable) or not a.name.isidentifier() or a.name.startswith('_'):
+            raise Exception('cannot compile with argument %s' % a)
+        names.append(a.name)
+    args = names
+
+    order = exp._topo()
+    namespace = {'_sin': _sin, '_cos': _cos, '_sign': _sign, '_np': np, '_reciprocal': _reciprocal,
+                 '_pow': _pow, '_pow_dbase': _pow_dbase, '_pow_log': _pow_log}
+    names = {}
+    lines = []
+    for node in order:
+        if isinstance(node, Variable):
+            if node.name not in args:
+                raise Exception('%s not found' % node.name)
+            names[id(node)] = node.name
+        elif isinstance(node, Const):
+            name = '_c%d' % len(names)
+            namespace[name] = node.value
+            names[id(node)] = name
+        else:
+            name = '_t%d' % len(names)
+            lines.append('%s = %s' % (name, node._code([names[id(c)] for c in node.children()])))
+            names[id(node)] = name
+    result = names[id(exp)]
+
+    if grad:
+        # 反向扫描：_g开头的是节点的伴随值，_d开头的是每个参数的偏导数
+        grads = {}
+        for i, name in enumerate(args):
+            lines.append('_d%d = 0' % i)
+        lines.append('_g = 1')
+        grads[id(exp)] = '_g'
+        for node in reversed(order):
+            if isinstance(node, Variable):
+                lines.append('_d{0} = _d{0} + {1}'.format(args.index(node.name), grads[id(node)]))
+                continue
+            children = node.children()
+            partials = node._partials_code([names[id(c)] for c in children], names[id(node)])
+            for child, partial in zip(children, partials):
+                if isinstance(child, Const):
+                    continue
+                g = grads[id(node)]
+                if partial == '1':
+                    term = g
+                elif partial == '-1':
+                    term = '-%s' % g
+                else:
+                    term = '%s * (%s)' % (g, partial)
+                if id(child) in grads:
+                    lines.append('{0} = {0} + {1}'.format(grads[id(child)], term))
+                else:
+                    grads[id(child)] = '_g%d' % len(grads)
+                    lines.append('%s = %s' % (grads[id(child)], term))
+        result = '%s, [%s]' % (result, ', '.join('_d%d' % i for i in range(len(args))))
+
+    source = 'def _compiled(%s):\n' % ', '.join(args)
+    for line in lines:
+        source += '    %s\n' % line
+    source += '    return %s\n' % result
+    exec(compile(source, '<compiled %s>' % type(exp).__name__, 'exec'), namespace)
+    func = namespace['_compiled']
+    func.source = source
+    return func
 
 
 if __name__ == '__main__':
@@ -260,3 +1510,30 @@ if __name__ == '__main__':
     print(y.eval(x=3))
     print(y.deriv(x))
 
+    print('-' * 100)
+    y = Variable('y')
+    z = Exp.sin(x * y) + x / (y * y)
+    print(z.eval(x=3, y=2))
+    print(grad(z, [x, 'y'], x=3, y=2))
+    print(z.deriv(x).eval(x=3, y=2), z.deriv(y).eval(x=3, y=2))
+    print(z.deriv(x))
+    print(z.deriv(x, simplify=True))
+
+    print('-' * 100)
+    xs = np.linspace(-1, 1, 5)
+    print(z.eval(x=xs, y=2.0))
+    print(z.deriv(x).eval(x=xs, y=2.0))
+    print(grad(abs(z), [x, y], x=xs, y=2.0))
+
+    print('-' * 100)
+    from concurrent.futures import ThreadPoolExecutor
+    w = abs(z) * Exp.cos(x)
+    with ThreadPoolExecutor(4) as pool:
+        for value, dot in pool.map(lambda v: eval_with_grad(w, x, x=v, y=2.0), [-1.0, -0.5, 0.5, 1.0]):
+            print(value, dot)
+    print(w.deriv(x).eval(x=-1.0, y=2.0))
+
+    print('-' * 100)
+    f = z.compile(['x', 'y'], grad=True)
+    print(f.source)
+    print(f(3, 2))
@@ -0,0 +1,266 @@
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+import numpy as np
+import p13_auto_derivative as auto
+
+
+def timeit(func, repeat=3):
+    """
+    返回func执行repeat次中最快的一次耗时（秒）
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        cost = time.perf_counter() - start
+        if best is None or cost < best:
+            best = cost
+    return best
+
+
+def sample_exp():
+    x = auto.Variable('x')
+    y = auto.Variable('y')
+    return auto.Exp.sin(x * y) + x / (y * y + 1) - auto.Exp.cos(x) * x
+
+
+def bench_array(n_scalar=20000, n_array=1000000):
+    """
+    标量逐点求值 与 NumPy数组一次性求值 的吞吐量对比（点/秒）
+    """
+    exp = sample_exp()
+    dexp = exp.deriv(auto.Variable('x'))
+    xs = np.random.uniform(-3, 3, n_array)
+    ys = np.random.uniform(-3, 3, n_array)
+
+    result = {}
+    for name, e in (('eval', exp), ('deriv', dexp)):
+        scalar_x, scalar_y = xs[:n_scalar].tolist(), ys[:n_scalar].tolist()
+        cost = timeit(lambda: [e.eval(x=a, y=b) for a, b in zip(scalar_x, scalar_y)], repeat=1)
+        scalar = n_scalar / cost
+        cost = timeit(lambda: e.eval(x=xs, y=ys))
+        array = n_array / cost
+        result[name] = {'scalar': scalar, 'array': array, 'speedup': array / scalar}
+    return result
+
+
+def bench_compile(n=20000):
+    """
+    解释执行 eval/grad 与 编译后函数 的每秒调用次数对比
+    """
+    exp = sample_exp()
+    points = np.random.uniform(-3, 3, [n, 2]).tolist()
+    value = exp.compile(['x', 'y'])
+    value_grad = exp.compile(['x', 'y'], grad=True)
+
+    result = {}
+    cost = timeit(lambda: [exp.eval(x=a, y=b) for a, b in points], repeat=1)
+    result['eval'] = n / cost
+    cost = timeit(lambda: [value(a, b) for a, b in points])
+    result['compiled eval'] = n / cost
+    cost = timeit(lambda: [auto.grad(exp, ['x', 'y'], x=a, y=b) for a, b in points], repeat=1)
+    result['grad'] = n / cost
+    cost = timeit(lambda: [value_grad(a, b) for a, b in points])
+    result['compiled grad'] = n / cost
+    return result
+
+
+def bench_nth_deriv(n=10, simplify=False):
+    """
+    连续求n阶导数，记录每一阶DAG节点数、展开成树的节点数、求导耗时和求值耗时
+    """
+    x = auto.Variable('x')
+    exp = auto.Exp.sin(x * x) * auto.Exp.cos(x) / (x * x + 1)
+    result = []
+    for order in range(1, n + 1):
+        start = time.perf_counter()
+        exp = exp.deriv(x, simplify=simplify)
+        deriv_cost = time.perf_counter() - start
+        eval_cost = timeit(lambda: exp.eval(x=0.5))
+        result.append({'order': order,
+                       'nodes': auto.count_nodes(exp),
+                       'tree_size': auto.tree_size(exp),
+                       'deriv_seconds': deriv_cost,
+                       'eval_seconds': eval_cost})
+    return result
+
+
+def bench_deep(sizes=(10 ** 4, 10 ** 5, 10 ** 6)):
+    """
+    sum(x*i for i in range(n)) 生成左深的加法链，检查求值/求导的耗时是否随节点数线性增长，且不会递归溢出
+    """
+    x = auto.Variable('x')
+    result = []
+    for size in sizes:
+        start = time.perf_counter()
+        exp = sum(x * i for i in range(size // 3))
+        build_cost = time.perf_counter() - start
+        nodes = auto.count_nodes(exp)
+        eval_cost = timeit(lambda: exp.eval(x=2.0), repeat=1)
+        start = time.perf_counter()
+        dexp = exp.deriv(x)
+        deriv_cost = time.perf_counter() - start
+        grad_cost = timeit(lambda: auto.grad(exp, [x], x=2.0), repeat=1)
+        result.append({'nodes': nodes, 'build_seconds': build_cost, 'eval_seconds': eval_cost,
+                       'deriv_seconds': deriv_cost, 'grad_seconds': grad_cost,
+                       'eval_us_per_node': eval_cost / nodes * 1e6})
+        del exp, dexp
+    return result
+
+
+def polynomial(n):
+    """
+    n次多项式，用秦九韶（Horner）形式 ((c_n*x + c_n-1)*x + ...) 构造
+    """
+    x = auto.Variable('x')
+    exp = auto.Const(1)
+    for k in range(n):
+        exp = exp * x + (k % 7 + 1)
+    return exp
+
+
+def nested_trig(n):
+    """
+    sin(cos(sin(...x...)))，共n层
+    """
+    exp = auto.Variable('x')
+    for k in range(n):
+        exp = auto.Exp.sin(exp) if k % 2 == 0 else auto.Exp.cos(exp)
+    return exp
+
+
+def long_product(n):
+    """
+    (x + 1) * (x + 2) * ... * (x + n)
+    """
+    x = auto.Variable('x')
+    exp = x + 1
+    for k in range(2, n + 1):
+        exp = exp * (x + k)
+    return exp
+
+
+def deep_quotient(n):
+    """
+    连分式 x / (1 + x / (2 + x / (... + x / n)))
+    """
+    x = auto.Variable('x')
+    exp = x / n
+    for k in range(n - 1, 0, -1):
+        exp = x / (k + exp)
+    return exp
+
+
+FAMILIES = {
+    'polynomial': polynomial,
+    'nested_trig': nested_trig,
+    'long_product': long_product,
+    'deep_quotient': deep_quotient,
+}
+
+
+def bench_family(name, size, x0=0.3):
+    """
+    一个表达式族在某个规模下的指标：节点数、树大小、每个节点的内存、求值吞吐量、求导构造时间
+    """
+    build = FAMILIES[name]
+    tracemalloc.start()
+    start = time.perf_counter()
+    exp = build(size)
+    build_cost = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    nodes = auto.count_nodes(exp)
+    exp.eval(x=x0)
+    eval_cost = timeit(lambda: exp.eval(x=x0))
+    start = time.perf_counter()
+    dexp = exp.deriv(auto.Variable('x'))
+    deriv_cost = time.perf_counter() - start
+    grad_cost = timeit(lambda: auto.grad(exp, ['x'], x=x0))
+    return {'family': name,
+            'size': size,
+            'nodes': nodes,
+            'tree_size': auto.tree_size(exp),
+            'build_seconds': build_cost,
+            'bytes_per_node': memory / nodes,
+            'evals_per_second': 1 / eval_cost,
+            'eval_ns_per_node': eval_cost / nodes * 1e9,
+            'deriv_seconds': deriv_cost,
+            'deriv_nodes': auto.count_nodes(dexp),
+            'grads_per_second': 1 / grad_cost}
+
+
+def bench_families(sizes=(10, 100, 1000)):
+    result = []
+    for name in FAMILIES:
+        for size in sizes:
+            result.append(bench_family(name, size))
+    return result
+
+
+def compare(old, new):
+    """
+    对比两次运行的表族结果，返回 (family, size, 指标, 新/旧) 的列表
+    """
+    old_rows = {(r['family'], r['size']): r for r in old['families']}
+    result = []
+    for r in new['families']:
+        o = old_rows.get((r['family'], r['size']))
+        if o is None:
+            continue
+        for metric in ('build_seconds', 'bytes_per_node', 'evals_per_second', 'deriv_seconds', 'grads_per_second'):
+            if o[metric]:
+                result.append((r['family'], r['size'], metric, r[metric] / o[metric]))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--json', default=None, help='write all results to this JSON file')
+    parser.add_argument('--compare', default=None, help='compare the family results with a previous JSON file')
+    parser.add_argument('--quick', action='store_true', help='only run the expression families with small sizes')
+    a = parser.parse_args()
+
+    results = {'python': platform.python_version(), 'numpy': np.__version__, 'time': time.time()}
+    results['families'] = bench_families((10, 100) if a.quick else (10, 100, 1000))
+    for r in results['families']:
+        print('%(family)-14s size = %(size)5d, nodes = %(nodes)6d, bytes/node = %(bytes_per_node)6.0f, '
+              'eval = %(evals_per_second)10.0f/s (%(eval_ns_per_node)6.0fns/node), '
+              'deriv = %(deriv_seconds).4fs, grad = %(grads_per_second)10.0f/s' % r)
+
+    if not a.quick:
+        results['array'] = bench_array()
+        for name, r in results['array'].items():
+            print('%-6s scalar = %12.0f points/s, array = %14.0f points/s, speedup = %.0fx'
+                  % (name, r['scalar'], r['array'], r['speedup']))
+
+        results['compile'] = bench_compile()
+        for name, calls in results['compile'].items():
+            print('%-14s %12.0f calls/s' % (name, calls))
+
+        results['nth_deriv'] = {}
+        for simplify in (False, True):
+            print('nth derivative, simplify = %s' % simplify)
+            results['nth_deriv'][str(simplify)] = bench_nth_deriv(simplify=simplify)
+            for r in results['nth_deriv'][str(simplify)]:
+                print('order %(order)2d: nodes = %(nodes)8d, tree size = %(tree_size)14d, '
+                      'deriv = %(deriv_seconds).4fs, eval = %(eval_seconds).4fs' % r)
+
+        results['deep'] = bench_deep()
+        for r in results['deep']:
+            print('deep chain %(nodes)8d nodes: build = %(build_seconds).2fs, eval = %(eval_seconds).2fs '
+                  '(%(eval_us_per_node).2fus/node), deriv = %(deriv_seconds).2fs, grad = %(grad_seconds).2fs' % r)
+
+    if a.json:
+        with open(a.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if a.compare:
+        with open(a.compare) as f:
+            old = json.load(f)
+        for family, size, metric, ratio in compare(old, results):
+            print('%-14s size = %5d %-18s new/old = %.2f' % (family, size, metric, ratio))
@@ -0,0 +1,85 @@
+import importlib.util
+import time
+import numpy as np
+import p13_auto_derivative as auto
+
+
+def load_bike():
+    """
+    p34.bike.py 的文件名中有'.'，不能直接import，按路径加载
+    """
+    spec = importlib.util.spec_from_file_location('p34_bike', 'p34.bike.py')
+    bike = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bike)
+    return bike
+
+
+def bike_arrays(bike):
+    arrays, _ = bike.load_dataset()
+    return (arrays['train_features'].astype(np.float64), arrays['train_targets'][:, 0].astype(np.float64),
+            arrays['val_features'].astype(np.float64), arrays['val_targets'][:, 0].astype(np.float64))
+
+
+def build_loss():
+    """
+    与 p34 中 NeuralNetwork 相同的结构：sigmoid隐藏层 + 线性输出层，
+    损失取 0.5 * mean(error^2)，它的梯度正好是手写反向传播中的 delta / n_records
+    """
+    x = auto.Variable('X')
+    y = auto.Variable('Y')
+    w1 = auto.Variable('W1')
+    w2 = auto.Variable('W2')
+    output = auto.Exp.sigmoid(x @ w1) @ w2
+    error = output - y
+    return auto.Exp.mean(error * error) * 0.5, output
+
+
+def train_hand_coded(network, train_x, train_y, batches, method='train'):
+    start = time.perf_counter()
+    train = getattr(network, method)
+    for batch in batches:
+        train(train_x[batch], train_y[batch])
+    return time.perf_counter() - start
+
+
+def train_auto(weights, learning_rate, train_x, train_y, batches):
+    loss, _ = build_loss()
+    w1, w2 = weights
+    start = time.perf_counter()
+    for batch in batches:
+        g1, g2 = auto.grad(loss, ['W1', 'W2'], X=train_x[batch], Y=train_y[batch][:, None], W1=w1, W2=w2)
+        w1 = w1 - learning_rate * g1
+        w2 = w2 - learning_rate * g2
+    return time.perf_counter() - start, (w1, w2)
+
+
+def bench_bike(epochs=2000, hidden_nodes=8, learning_rate=0.5, batch_size=128):
+    """
+    用同样的初始权重、同样的mini batch，分别用手写的逐条记录反向传播、整批反向传播和p13引擎的grad训练，
+    比较耗时和验证损失
+    """
+    bike = load_bike()
+    train_x, train_y, val_x, val_y = bike_arrays(bike)
+    batches = [np.random.randint(0, len(train_x), batch_size) for _ in range(epochs)]
+
+    base = bike.NeuralNetwork(train_x.shape[1], hidden_nodes, 1, learning_rate)
+    weights = (base.weights_input_to_hidden.copy(), base.weights_hidden_to_output.copy())
+
+    result = {}
+    for name, method in (('per_record', 'train_per_record'), ('batched', 'train')):
+        network = bike.NeuralNetwork(train_x.shape[1], hidden_nodes, 1, learning_rate)
+        network.weights_input_to_hidden[:], network.weights_hidden_to_output[:] = weights
+        seconds = train_hand_coded(network, train_x, train_y, batches, method)
+        result[name] = {'seconds': seconds, 'val_loss': bike.MSE(network.run(val_x).T, val_y)}
+
+    seconds, (w1, w2) = train_auto(weights, learning_rate, train_x, train_y, batches)
+    _, output = build_loss()
+    result['p13_auto'] = {'seconds': seconds, 'val_loss': bike.MSE(output.eval(X=val_x, W1=w1, W2=w2).T, val_y)}
+    return result
+
+
+if __name__ == '__main__':
+    r = bench_bike()
+    for name in r:
+        print('%-10s %.2fs (%.1fx vs per_record), val loss = %.4f'
+              % (name, r[name]['seconds'], r['per_record']['seconds'] / r[name]['seconds'], r[name]['val_loss']))
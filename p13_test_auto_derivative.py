@@ -1,5 +1,6 @@
 import p13_auto_derivative as auto
 import math
+import numpy as np
 
 def train(y, x, epoches = 2000, lr = 0.01):
     dy_dx = y.deriv(x)
@@ -9,6 +10,110 @@ def train(y, x, epoches = 2000, lr = 0.01):
         x0 -= lr * dy_dx.eval(x=x0)
     return x0
 
+def test_matmul_constant_operand():
+    """
+    矩阵乘法的一边是常量（或与求导变量无关）时，正向模式、符号求导都要与反向模式的梯度之和一致
+    """
+    A = np.arange(6.).reshape(2, 3)
+    W0 = np.arange(12.).reshape(3, 4) / 10
+    W = auto.Variable('W')
+    x = auto.Variable('x')
+    expected = np.sum(auto.grad(auto.Exp.sum(A @ W), [W], W=W0)[0])
+
+    _, dot = auto.eval_with_grad(auto.Exp.sum(A @ W), W, W=W0)
+    assert np.isclose(dot, expected)
+    assert np.isclose(auto.Exp.sum(x @ W).deriv(W).eval(x=A, W=W0), expected)
+    assert np.isclose(auto.Exp.sum(x @ W).deriv(W, simplify=True).eval(x=A, W=W0), expected)
+    assert np.isclose(auto.Exp.sum(A @ W).deriv(x).eval(W=W0), 0)
+
+
+
+def test_grad_python_scalar_variable():
+    """
+    变量取Python标量、输出是标量时，反向模式的梯度要约简成标量，与NumPy标量、正向模式一致
+    """
+    x = auto.Variable('x')
+    A = np.arange(3.)
+    y = auto.Exp.sum(x * A)
+    g, = auto.grad(y, ['x'], x=2.0, A=A)
+    assert np.ndim(g) == 0 and np.isclose(g, 3.0)
+    assert np.isclose(auto.grad(y, ['x'], x=np.float64(2.0), A=A)[0], g)
+    assert np.isclose(auto.eval_with_grad(y, x, x=2.0, A=A)[1], g)
+    # 输出是数组时保留逐点的梯度
+    g, = auto.grad(x * A, ['x'], x=2.0, A=A)
+    assert np.allclose(g, A)
+
+
+
+def test_reduce_axis_arguments():
+    """
+    Sum/Mean 的 axis 可以用关键字参数，也可以是列表
+    """
+    x = auto.Variable('x')
+    value = np.arange(6.).reshape(2, 3)
+    assert np.allclose(auto.Sum(x, axis=0).eval(x=value), value.sum(axis=0))
+    assert np.allclose(auto.Mean(x, axis=[0, 1]).eval(x=value), value.mean())
+    s = auto.Exp.sum(x, [0, 1])
+    assert s.axis == (0, 1) and s is auto.Exp.sum(x, (0, 1))
+    assert np.allclose(auto.grad(s, [x], x=value)[0], np.ones_like(value))
+
+
+
+def test_compile_grad_pow_exp_log_sigmoid():
+    """
+    含 **、exp、log、sigmoid 的表达式编译成带梯度的函数，结果与 grad() 一致
+    """
+    x = auto.Variable('x')
+    y = auto.Variable('y')
+    e = x ** y + auto.Exp.exp(x * y) + auto.Exp.log(x) + auto.Exp.sigmoid(x - y) + x ** 0.5
+    value, grads = e.compile(['x', 'y'], grad=True)(2.0, 3.0)
+    assert np.isclose(value, e.eval(x=2.0, y=3.0))
+    assert np.allclose(grads, auto.grad(e, [x, y], x=2.0, y=3.0))
+
+
+def test_pow_domain():
+    """
+    负数的非整数次幂报错，而不是返回复数；sqrt在0处的导数是inf，而不是抛出ZeroDivisionError
+    """
+    x = auto.Variable('x')
+    for value in (-4.0, np.array([-4.0, 4.0])):
+        try:
+            (x ** 0.5).eval(x=value)
+        except Exception as e:
+            assert 'non-integer power' in str(e)
+        else:
+            assert False, 'expect an exception'
+    assert auto.grad(x ** 0.5, [x], x=0.0)[0] == math.inf
+
+
+def test_simplify_keeps_shape():
+    """
+    同类项相消、乘0、0除以x折叠后取值的形状不能变小（变量的取值可能是数组）
+    """
+    X = auto.Variable('X')
+    W = auto.Variable('W')
+    V = auto.Variable('V')
+    b = auto.Variable('b')
+    s = auto.Variable('s')
+    env = {'X': np.ones((4, 3)), 'W': np.ones((3, 2)), 'V': np.arange(8.), 'b': 2.0, 's': 3.0}
+    cases = [auto.Exp.sum(X @ W - X @ W + 1),
+             auto.Exp.sum(0 * V + b),
+             auto.Exp.sum(X @ W * 0 + s),
+             auto.Exp.sum(0 / (V + 1) + b),
+             auto.Exp.sum(V ** 0)]
+    for e in cases:
+        assert np.isclose(auto.simplify(e).eval(**env), e.eval(**env)), e
+    e = auto.Exp.sum(V * b - V * b + b)
+    assert np.isclose(e.deriv(b, simplify=True).eval(**env), 8.0)
+    assert np.isclose(e.deriv(b).eval(**env), 8.0)
+    # 去掉的项的形状已被其他项覆盖时不额外广播，否则用broadcast保留
+    x = auto.Variable('x')
+    y = auto.Variable('y')
+    assert repr(auto.simplify(x - x + x * y)) == '(x * y)'
+    assert repr(auto.simplify(x * y - x * y + x)) == 'broadcast(x, (x * y))'
+    assert repr(auto.simplify(auto.Exp.sin(x * y)).deriv(x, simplify=True)) == '(cos((x * y)) * y)'
+
+
 if __name__ == '__main__':
     x = auto.Variable('x')
     for a in range(2,10):
@@ -3,6 +3,7 @@ import numpy as np
 import cv2
 import argparse
 from tensorflow.examples.tutorials.mnist.input_data import read_data_sets
+import summary_writer
 
 class Config:
     def __init__(self):
@@ -15,6 +16,8 @@ class Config:
         self.sample_path = './data/MNIST_data'
         self.filters = 32
         self.logdir = './logs/{name}'.format(name=self.name)
+        # 每隔多少步写一次 summary，见 summary_writer.py
+        self.summary_every = 10
         self.vector_size = 2
         self.decay_rate = 0.995
         self.image_path = 'images/{name}/%s.jpg'.format(name=self.name)
@@ -191,7 +194,7 @@ class Mnist:
             self.session = tf.Session(config = conf, graph = graph)
             self.tensors = Tensors(config)
             self.saver = tf.train.Saver()
-            self.file_writer = tf.summary.FileWriter(logdir=config.logdir, graph = graph)
+            self.file_writer = summary_writer.SummaryWriter(config.logdir, graph, self.tensors.summary_op, config.summary_every)
             try:
                 self.saver.restore(self.session, config.save_path)
                 print('restore the model successfully')
@@ -213,11 +216,9 @@ class Mnist:
                     self.tensors.y: y,
                     self.tensors.lr: cfg.lr
                 }
-                _, lo, su = self.session.run([self.tensors.train_op,
-                                  self.tensors.loss,
-                                  self.tensors.summary_op], feed_dict=feed_dict)
+                _, lo = self.file_writer.run(self.session, [self.tensors.train_op,
+                                  self.tensors.loss], feed_dict, epoch*batches + batch)
                 print('%d/%d, loss = %f' % (epoch, batch,lo))
-                self.file_writer.add_summary(su, epoch*batches + batch)
             self.saver.save(self.session, cfg.save_path)
             self.predict(epoch)
 
@@ -250,6 +251,7 @@ class Mnist:
         print('image saved to ', path, flush = True)
 
     def close(self):
+        self.file_writer.close()
         self.session.close()
 
 if __name__ == '__main__':
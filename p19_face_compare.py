@@ -3,12 +3,16 @@ import numpy as np
 import argparse
 
 import os
+import accumulate
+import summary_writer
 
 
 
 class Config:
     def __init__(self):
         self.batch_size = 2
+        # 每累积多少个batch的梯度才更新一次参数，内存放不下大batch时，实际的batch大小是 batch_size * accumulate
+        self.accumulate = 1
         self.epoches = 10
         self.eps = 1e-8
         self.lr = 0.001
@@ -17,6 +21,8 @@ class Config:
         self.sample_path = '/Users/cjz/data/pic'
         self.filters = 2
         self.logdir = './logs/{name}'.format(name=self.name)
+        # 每隔多少步写一次 summary，见 summary_writer.py
+        self.summary_every = 10
         self.vector_size = 2  # should be about 90000 in practice.
 
     def from_cmd_line(self):
@@ -93,7 +99,8 @@ class Tensors:
             self.lr = tf.placeholder(tf.float32, [], 'lr')
             opt = tf.train.AdamOptimizer(self.lr)
             with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
-                self.train_op = opt.minimize(self.loss)
+                self.accumulator = accumulate.Accumulator(opt, opt.compute_gradients(self.loss), config.accumulate)
+                self.train_op = self.accumulator.train_op
 
 
 
@@ -223,7 +230,7 @@ class Face_recognition:
             conf.allow_soft_placement = True
             self.session = tf.Session(config = conf, graph = graph)
             self.tensors = Tensors(config)
-            self.file_writer = tf.summary.FileWriter(logdir=config.logdir, graph = graph)
+            self.file_writer = summary_writer.SummaryWriter(config.logdir, graph, self.tensors.summary_op, config.summary_every)
             self.saver = tf.train.Saver()
             try:
                 self.saver.restore(self.session, config.save_path)
@@ -236,6 +243,7 @@ class Face_recognition:
         cfg = self.config
 
         self.session.run(tf.global_variables_initializer())
+        self.session.run(self.tensors.accumulator.init_op)
         for epoch in range(cfg.epoches):
             batches = self.samples.num // cfg.batch_size
             for batch in range(batches):
@@ -247,14 +255,13 @@ class Face_recognition:
                     self.tensors.lr: cfg.lr,
                     self.tensors.training: True
                 }
-                _, lo, su = self.session.run([self.tensors.train_op,
-                                  self.tensors.loss,
-                                  self.tensors.summary_op], feed_dict)
+                _, lo = self.file_writer.run(self.session, [self.tensors.accumulator.step_op(epoch * batches + batch),
+                                  self.tensors.loss], feed_dict, epoch*batches + batch)
                 print('%d/%d, loss = %f' % (epoch, batch, lo))
-                self.file_writer.add_summary(su, epoch*batches + batch)
             self.saver.save(self.session, cfg.save_path)
 
     def close(self):
+        self.file_writer.close()
         self.session.close()
         self.samples.close()
 
@@ -1,6 +1,7 @@
 import tensorflow as tf
 import numpy as np
 import argparse
+import summary_writer
 
 
 class Config:
@@ -15,6 +16,8 @@ class Config:
         self.name = 'p20'
         self.save_path = 'models/{name}/{name}'.format(name=self.name)
         self.logdir = 'logs/{name}/'.format(name=self.name)
+        # 每隔多少步写一次 summary，见 summary_writer.py
+        self.summary_every = 10
         self.lr = 0.0002
         self.epoches = 10
 
@@ -142,7 +145,7 @@ class Stock:
 
         cfg.stock_num = 14
         self.samples = Samples(config)
-        writer = tf.summary.FileWriter(cfg.logdir, self.session.graph)
+        writer = summary_writer.SummaryWriter(cfg.logdir, self.session.graph, self.tensors.summary_op, cfg.summary_every)
 
 
         for epoch in range(cfg.epoches):
@@ -153,13 +156,12 @@ class Stock:
                     self.tensors.x: x,
                     self.tensors.y: y
                 }
-                _, loss, su= self.session.run([self.tensors.train_op, self.tensors.loss, self.tensors.summary_op],
-                                               feed_dict)
-                writer.add_summary(su, epoch * self.samples.num() + batch)
+                _, loss = writer.run(self.session, [self.tensors.train_op, self.tensors.loss], feed_dict, epoch * self.samples.num() + batch)
                 print('%d/%d: loss=%.8f' % (batch, epoch, loss))
                 #print('%d/%d: %d' % (batch, epoch, y.shape[0]))
             self.saver.save(self.session, cfg.save_path)
             print('Save the mode into ', cfg.save_path)
+        writer.close()
 
 
     def close(self):
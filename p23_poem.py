@@ -1,28 +1,40 @@
 import tensorflow as tf
 import numpy as np
 import argparse
-import os
+import multi_tower
+import accumulate
+import summary_writer
 
 
 class Config:
     def __init__(self):
         self.batch_size = 50
+        # 每累积多少个batch的梯度才更新一次参数，内存放不下大batch时，实际的batch大小是 batch_size * accumulate
+        self.accumulate = 1
         self.num_step = 8 * 4
         self.num_units = 200
+        # gpu: 每个GPU一个塔；cpu: 建立多个虚拟CPU设备，每个设备一个塔
+        self.device_type = 'gpu'
         self.gpus = self.get_gpus()
+        # 塔的数量，0 表示默认值：gpu 为 gpus，cpu 为CPU核数，可以在命令行中用 --towers 指定
+        self.towers = 0
 
         self.sample_path = 'qts_7X4.txt'
 
         self.name = 'p23'
         self.save_path = 'models/{name}/{name}'.format(name=self.name)
         self.logdir = 'logs/{name}/'.format(name=self.name)
+        # 每隔多少步写一次 summary，见 summary_writer.py
+        self.summary_every = 10
 
         self.lr = 0.0002
         self.epoches = 100
 
     def get_gpus(self):
-        value = os.getenv('CUDA_VISIBLE_DEVICES', '0')
-        return len(value.split(','))
+        return multi_tower.get_gpus()
+
+    def get_towers(self):
+        return multi_tower.num_towers(self.device_type, self.towers, self.gpus)
 
     def from_cmd_line(self):
         parser = argparse.ArgumentParser()
@@ -41,50 +53,30 @@ class Config:
 class Tensors:
     def __init__(self, config: Config, char_size):
         self.config = config
-        self.sub_tensors = []
-        with tf.device('/gpu:0'):
+        devices = multi_tower.get_devices(config.device_type, config.get_towers())
+        with tf.device(devices[0]):
             self.lr = tf.placeholder(tf.float32, [], 'lr')
             opt = tf.train.AdamOptimizer(self.lr)
 
-        with tf.variable_scope('poem'):
-            for gpu_index in range(config.gpus):
-                self.sub_tensors.append(Sub_tensors(config, gpu_index, opt, char_size))
-                tf.get_variable_scope().reuse_variables()
+        self.towers = multi_tower.Towers(devices, lambda device: Sub_tensors(config, device, opt, char_size), 'poem')
+        self.sub_tensors = self.towers.towers
 
-        with tf.device('/gpu:0'):
-            grad = self.merge_grads()
-            self.train_op = opt.apply_gradients(grad)
+        with tf.device(devices[0]):
+            self.accumulator = accumulate.Accumulator(opt, self.towers.merge_grads(), config.accumulate)
+            self.train_op = self.accumulator.train_op
+            # char_dict 本步实际更新的行数（各塔去重后的字数）
+            self.rows_touched = self.towers.total_rows_touched()
             self.loss = tf.reduce_mean([ts.loss for ts in self.sub_tensors])
             self.precise = tf.reduce_mean([ts.precise for ts in self.sub_tensors])
             tf.summary.scalar('loss', self.loss)
             tf.summary.scalar('precise', self.precise)
+            tf.summary.scalar('rows_touched', self.rows_touched)
             self.summary_op = tf.summary.merge_all()
 
-    def merge_grads(self):
-        grads = {}
-        indexed_grads = {}
-        for ts in self.sub_tensors:
-            for g, v in ts.grad:
-                if isinstance(g, tf.IndexedSlices):
-                    if v not in indexed_grads:
-                        indexed_grads[v] = []
-                    indexed_grads[v].append(g)
-                else:
-                    if v not in grads:
-                        grads[v] = []
-                    grads[v].append(g)
-        result = [(tf.reduce_mean(grads[v], axis = 0), v) for v in grads]
-        for v in indexed_grads:
-            indices = tf.concat([g.indices for g in indexed_grads[v]], axis = 0)
-            values = tf.concat([g.values for g in indexed_grads[v]], axis = 0)
-            g = tf.IndexedSlices(values, indices)
-            result.append((g, v))
-
-        return result
 
 class Sub_tensors:
-    def __init__(self, config: Config, gpu_index, opt: tf.train.AdamOptimizer, char_size):
-        with tf.device('/gpu:%d' % gpu_index):
+    def __init__(self, config: Config, device, opt: tf.train.AdamOptimizer, char_size):
+        with tf.device(device):
             self.x = tf.placeholder(tf.int32, [None, config.num_step], 'x') #-1, 32
             char_dict = tf.get_variable('char_dict', [char_size, config.num_units], tf.float32)#4000, 200
             x = tf.nn.embedding_lookup(char_dict, self.x)#-1, 32, 200
@@ -275,12 +267,11 @@ class Poem:
         self.config = config
         graph = tf.Graph()
         with graph.as_default():
-            conf = tf.ConfigProto()
-            conf.allow_soft_placement = True
+            conf = multi_tower.session_config(config.device_type, config.get_towers())
             self.session = tf.Session(config=conf, graph=graph)
             self.samples = Samples(config)
             self.tensors = Tensors(config, self.samples.char_size)
-            self.file_write = tf.summary.FileWriter(logdir=config.logdir, graph=graph)
+            self.file_write = summary_writer.SummaryWriter(config.logdir, graph, self.tensors.summary_op, config.summary_every)
             self.saver = tf.train.Saver()
             try:
                 self.saver.restore(self.session, config.save_path)
@@ -289,24 +280,26 @@ class Poem:
 
     def train(self):
         config = self.config
-        batches = self.samples.poem_size // (config.gpus * config.batch_size)
+        self.session.run(self.tensors.accumulator.init_op)
+        batches = self.samples.poem_size // (config.get_towers() * config.batch_size)
         for epoch in range(config.epoches):
             for batch in range(batches):
                 feed_dict = {
                     self.tensors.lr:config.lr
                 }
-                for gpu_index in range(config.gpus):
+                for gpu_index in range(config.get_towers()):
                     x = self.samples.next_batch(config.batch_size)
                     feed_dict[self.tensors.sub_tensors[gpu_index].x] = x
-                _, loss, precise, su = self.session.run([self.tensors.train_op,
+                _, loss, precise, rows = self.file_write.run(self.session,
+                              [self.tensors.accumulator.step_op(epoch * batches + batch),
                               self.tensors.loss,
                               self.tensors.precise,
-                              self.tensors.summary_op], feed_dict)
-                self.file_write.add_summary(su, epoch*batches + batch)
-                print('%d/%d, loss = %f, precise = %f' % (epoch, batch, loss, precise))
+                              self.tensors.rows_touched], feed_dict, epoch*batches + batch)
+                print('%d/%d, loss = %f, precise = %f, rows touched = %d' % (epoch, batch, loss, precise, rows))
             self.saver.save(self.session, config.save_path)
 
     def close(self):
+        self.file_write.close()
         self.session.close()
 
     def predict(self, head=None):
@@ -339,6 +332,7 @@ class Poem:
 
 if __name__ == '__main__':
     config = Config()
+    config.from_cmd_line()
     s = Samples(config)
     # Tensors(config, s.char_size)
     poem = Poem(config)
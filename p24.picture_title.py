@@ -1,28 +1,40 @@
 import tensorflow as tf
 import numpy as np
 import argparse
-import os
+import multi_tower
+import accumulate
+import summary_writer
 
 
 class Config:
     def __init__(self):
         self.batch_size = 2
+        # 每累积多少个batch的梯度才更新一次参数，内存放不下大batch时，实际的batch大小是 batch_size * accumulate
+        self.accumulate = 1
         self.num_step = 8 * 4
         self.num_units = 10
+        # gpu: 每个GPU一个塔；cpu: 建立多个虚拟CPU设备，每个设备一个塔
+        self.device_type = 'gpu'
         self.gpus = self.get_gpus()
+        # 塔的数量，0 表示默认值：gpu 为 gpus，cpu 为CPU核数，可以在命令行中用 --towers 指定
+        self.towers = 0
         self.filters = 2#64
         self.picture_size = 224
 
         self.name = 'p24'
         self.save_path = 'models/{name}/{name}'.format(name=self.name)
         self.logdir = 'logs/{name}/'.format(name=self.name)
+        # 每隔多少步写一次 summary，见 summary_writer.py
+        self.summary_every = 10
 
         self.lr = 0.0002
         self.epoches = 100
 
     def get_gpus(self):
-        value = os.getenv('CUDA_VISIBLE_DEVICES', '0')
-        return len(value.split(','))
+        return multi_tower.get_gpus()
+
+    def get_towers(self):
+        return multi_tower.num_towers(self.device_type, self.towers, self.gpus)
 
     def from_cmd_line(self):
         parser = argparse.ArgumentParser()
@@ -40,20 +52,18 @@ class Config:
 class Tensors:
     def __init__(self, config: Config, char_size):
         self.config = config
-        self.sub_tensors = []
-        with tf.device('/gpu:0'):
+        devices = multi_tower.get_devices(config.device_type, config.get_towers())
+        with tf.device(devices[0]):
             self.lr = tf.placeholder(tf.float32, [], 'lr')
             self.training = tf.placeholder(tf.bool, [], 'training')
             opt = tf.train.AdamOptimizer(self.lr)
 
-        with tf.variable_scope('picture_title'):
-            for gpu_index in range(config.gpus):
-                self.sub_tensors.append(Sub_tensors(config, gpu_index, opt, char_size, self.training))
-                tf.get_variable_scope().reuse_variables()
+        self.towers = multi_tower.Towers(devices, lambda device: Sub_tensors(config, device, opt, char_size, self.training), 'picture_title')
+        self.sub_tensors = self.towers.towers
 
-        with tf.device('/gpu:0'):
-            grad = self.merge_grads()
-            self.train_op = opt.apply_gradients(grad)
+        with tf.device(devices[0]):
+            self.accumulator = accumulate.Accumulator(opt, self.towers.merge_grads(), config.accumulate)
+            self.train_op = self.accumulator.train_op
             self.loss = tf.reduce_mean([ts.loss for ts in self.sub_tensors])
             self.precise = tf.reduce_mean([ts.precise for ts in self.sub_tensors])
 
@@ -61,33 +71,13 @@ class Tensors:
             tf.summary.scalar('precise', self.precise)
             self.summary_op = tf.summary.merge_all()
 
-    def merge_grads(self):
-        grads = {}
-        indexed_grads = {}
-        for ts in self.sub_tensors:
-            for g, v in ts.grad:
-                if isinstance(g, tf.IndexedSlices):
-                    if v not in indexed_grads:
-                        indexed_grads[v] = []
-                    indexed_grads[v].append(g)
-            else:
-                if v not in grads:
-                    grads[v] = []
-                grads[v].append(g)
-        result = [(tf.reduce_mean(grads[v], axis = 0), v) for v in grads]
-        for v in indexed_grads:
-            indices = tf.concat([g.indices for g in indexed_grads[v]], axis = 0)
-            values = tf.concat([g.values for g in indexed_grads[v]], axis=0)
-            g = tf.IndexedSlices(values, indices)
-            result.append((g, v))
-        return result
 
 
 class Sub_tensors:
-    def __init__(self, config: Config, gpu_index, opt: tf.train.AdamOptimizer, char_size, training):
+    def __init__(self, config: Config, device, opt: tf.train.AdamOptimizer, char_size, training):
         self.config = config
         self.training = training
-        with tf.device('/gpu:%d' % gpu_index):
+        with tf.device(device):
             self.x = tf.placeholder(tf.float32, [None, config.picture_size, config.picture_size, 3], 'x')
             with tf.variable_scope('resnet50'):
                 x = self.resnet50(self.x)
@@ -199,12 +189,11 @@ class Pic_title:
         self.config = config
         graph = tf.Graph()
         with graph.as_default():
-            conf = tf.ConfigProto()
-            conf.allow_soft_placement = True
+            conf = multi_tower.session_config(config.device_type, config.get_towers())
             self.session = tf.Session(config=conf, graph=graph)
             self.samples = Samples(config)
             self.tensors = Tensors(config, self.samples.char_size)
-            self.file_writer = tf.summary.FileWriter(logdir=config.logdir, graph=graph)
+            self.file_writer = summary_writer.SummaryWriter(config.logdir, graph, self.tensors.summary_op, config.summary_every)
             self.saver = tf.train.Saver()
             try:
                 self.saver.restore(self.session, config.save_path)
@@ -213,22 +202,21 @@ class Pic_title:
 
     def train(self):
         config = self.config
-        batches = self.samples.num // (config.gpus * config.batch_size)
+        self.session.run(self.tensors.accumulator.init_op)
+        batches = self.samples.num // (config.get_towers() * config.batch_size)
         for epoch in range(config.epoches):
             for batch in range(batches):
                 feed_dict = {
                     self.tensors.lr: config.lr,
                     self.tensors.training: True
                 }
-                for gpu_index in range(config.gpus):
+                for gpu_index in range(config.get_towers()):
                     x, y = self.samples.next_batch(config.batch_size)
                     feed_dict[self.tensors.sub_tensors[gpu_index].x] = x
                     feed_dict[self.tensors.sub_tensors[gpu_index].y] = y
-                _, loss, precise, su = self.session.run([self.tensors.train_op,
+                _, loss, precise = self.file_writer.run(self.session, [self.tensors.accumulator.step_op(epoch * batches + batch),
                                   self.tensors.loss,
-                                  self.tensors.precise,
-                                  self.tensors.summary_op], feed_dict=feed_dict)
-                self.file_writer.add_summary(su, epoch*batches + batch)
+                                  self.tensors.precise], feed_dict, epoch*batches + batch)
                 print('%d/%d, loss=%f, precise=%f' % (epoch, batch, loss, precise))
             self.saver.save(self.session, config.save_path)
 
@@ -236,11 +224,13 @@ class Pic_title:
 
 
     def close(self):
+        self.file_writer.close()
         self.session.close()
 
 
 if __name__ == '__main__':
     config = Config()
+    config.from_cmd_line()
     app = Pic_title(config)
     app.train()
 
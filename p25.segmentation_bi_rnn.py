@@ -1,28 +1,40 @@
 import tensorflow as tf
 import numpy as np
 import argparse
-import os
+import multi_tower
+import accumulate
+import summary_writer
 
 
 class Config:
     def __init__(self):
         self.batch_size = 2
+        # 每累积多少个batch的梯度才更新一次参数，内存放不下大batch时，实际的batch大小是 batch_size * accumulate
+        self.accumulate = 1
         self.num_step = 8 * 4
         self.num_units = 5#200
+        # gpu: 每个GPU一个塔；cpu: 建立多个虚拟CPU设备，每个设备一个塔
+        self.device_type = 'gpu'
         self.gpus = self.get_gpus()
+        # 塔的数量，0 表示默认值：gpu 为 gpus，cpu 为CPU核数，可以在命令行中用 --towers 指定
+        self.towers = 0
         self.classes = 4
         self.ch_size = 200
 
         self.name = 'p25'
         self.save_path = 'models/{name}/{name}'.format(name=self.name)
         self.logdir = 'logs/{name}/'.format(name=self.name)
+        # 每隔多少步写一次 summary，见 summary_writer.py
+        self.summary_every = 10
 
         self.lr = 0.0002
         self.epoches = 100
 
     def get_gpus(self):
-        value = os.getenv('CUDA_VISIBLE_DEVICES', '0')
-        return len(value.split(','))
+        return multi_tower.get_gpus()
+
+    def get_towers(self):
+        return multi_tower.num_towers(self.device_type, self.towers, self.gpus)
 
     def from_cmd_line(self):
         parser = argparse.ArgumentParser()
@@ -40,51 +52,29 @@ class Config:
 
 class Tensors:
     def __init__(self, config: Config):
-        self.sub_tensors = []
         self.config = config
-        with tf.device('/gpu:0'):
+        devices = multi_tower.get_devices(config.device_type, config.get_towers())
+        with tf.device(devices[0]):
             self.lr = tf.placeholder(tf.float32, [], 'lr')
             opt = tf.train.AdamOptimizer(self.lr)
 
-        with tf.variable_scope('segmentation'):
-            for gpu_index in range(config.gpus):
-                self.sub_tensors.append(Sub_tensors(config, gpu_index, opt))
-                tf.get_variable_scope().reuse_variables()
+        self.towers = multi_tower.Towers(devices, lambda device: Sub_tensors(config, device, opt), 'segmentation')
+        self.sub_tensors = self.towers.towers
 
-        with tf.device('/gpu:0'):
-            grad = self.merge_grads()
-            self.train_op = opt.apply_gradients(grad)
+        with tf.device(devices[0]):
+            self.accumulator = accumulate.Accumulator(opt, self.towers.merge_grads(), config.accumulate)
+            self.train_op = self.accumulator.train_op
+            # embedding 本步实际更新的行数（各塔去重后的字数），见 multi_tower.merge_grads
+            self.rows_touched = self.towers.total_rows_touched()
             self.loss = tf.reduce_mean([ts.loss for ts in self.sub_tensors])
             tf.summary.scalar('loss', self.loss)
+            tf.summary.scalar('rows_touched', self.rows_touched)
             self.summary_op = tf.summary.merge_all()
 
 
-
-    def merge_grads(self):
-        indexed_grads = {}
-        grads = {}
-        for ts in self.sub_tensors:
-            for g, v in ts.grad:
-                if isinstance(g, tf.IndexedSlices):
-                    if v not in indexed_grads:
-                        indexed_grads[v] = []
-                    indexed_grads[v].append(g)
-                else:
-                    if v not in grads:
-                        grads[v] = []
-                    grads[v].append(g)
-        result = [(tf.reduce_mean(grads[v], axis = 0),v) for v in grads]
-        for v in indexed_grads:
-            indices = tf.concat([g.indices for g in indexed_grads[v]], axis = 0)
-            values = tf.concat([g.values for g in indexed_grads[v]], axis = 0)
-            g = tf.IndexedSlices(values, indices)
-            result.append((g, v))
-        return result
-
-
 class Sub_tensors:
-    def __init__(self, config: Config, gpu_index, opt:tf.train.AdamOptimizer):
-        with tf.device('/gpu:%d' % gpu_index):
+    def __init__(self, config: Config, device, opt:tf.train.AdamOptimizer):
+        with tf.device(device):
             self.x = tf.placeholder(tf.int32, [None, config.num_step], 'x')
             char_dcit = tf.get_variable('char_size', [config.ch_size, config.num_units], tf.float32)
             x = tf.nn.embedding_lookup(char_dcit, self.x)#-1, 32, num_units
@@ -172,11 +162,10 @@ class App:
         with graph.as_default():
             self.samples = Samples(config)
             self.tensors = Tensors(config)
-            cfg = tf.ConfigProto()
-            cfg.allow_soft_placement = True
+            cfg = multi_tower.session_config(config.device_type, config.get_towers())
             self.session = tf.Session(config=cfg, graph=graph)
             self.saver = tf.train.Saver()
-            self.writer = tf.summary.FileWriter(config.logdir, self.session.graph)
+            self.writer = summary_writer.SummaryWriter(config.logdir, self.session.graph, self.tensors.summary_op, config.summary_every)
             try:
                 self.saver.restore(self.session, config.save_path)
                 print('Restore the model from %s successfully.' % config.save_path)
@@ -186,19 +175,19 @@ class App:
 
     def train(self):
         cfg = self.config
-        batches = self.samples.num() // (cfg.gpus * cfg.batch_size)
+        self.session.run(self.tensors.accumulator.init_op)
+        batches = self.samples.num() // (cfg.get_towers() * cfg.batch_size)
         for epoch in range(cfg.epoches):
             for batch in range(batches):
                 feed_dict = {
                     self.tensors.lr: cfg.lr
                 }
-                for gpu_index in range(cfg.gpus):
+                for gpu_index in range(cfg.get_towers()):
                     x, y = self.samples.next_batch(cfg.batch_size)
                     feed_dict[self.tensors.sub_tensors[gpu_index].x] = x
                     feed_dict[self.tensors.sub_tensors[gpu_index].y] = y
-                _, loss, su = self.session.run(
-                    [self.tensors.train_op, self.tensors.loss, self.tensors.summary_op], feed_dict)
-                self.writer.add_summary(su, epoch * batches + batch)
+                _, loss = self.writer.run(
+                    self.session, [self.tensors.accumulator.step_op(epoch * batches + batch), self.tensors.loss], feed_dict, epoch * batches + batch)
                 print('%d/%d: loss=%.8f' % (batch, epoch, loss), flush=True)
             self.saver.save(self.session, cfg.save_path)
             print('Save the mode into ', cfg.save_path, flush=True)
@@ -207,10 +196,12 @@ class App:
         pass
 
     def close(self):
+        self.writer.close()
         self.session.close()
 
 if __name__ == '__main__':
     config = Config()
+    config.from_cmd_line()
 
     app = App(config)
     app.train()
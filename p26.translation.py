@@ -1,30 +1,42 @@
 import tensorflow as tf
 import numpy as np
-import os
 import argparse
+import multi_tower
+import accumulate
+import summary_writer
 
 
 class Config:
     def __init__(self):
         self.batch_size = 20
+        # 每累积多少个batch的梯度才更新一次参数，内存放不下大batch时，实际的batch大小是 batch_size * accumulate
+        self.accumulate = 1
         self.num_step1 = 8
         self.num_step2 = 10
         self.num_units = 5
 
+        # gpu: 每个GPU一个塔；cpu: 建立多个虚拟CPU设备，每个设备一个塔
+        self.device_type = 'gpu'
         self.gpus = self.get_gpus()
+        # 塔的数量，0 表示默认值：gpu 为 gpus，cpu 为CPU核数，可以在命令行中用 --towers 指定
+        self.towers = 0
         self.ch_size = 200
         self.en_size = 100
 
         self.name = 'p26'
         self.save_path = 'models/{name}/{name}'.format(name=self.name)
         self.logdir = 'logs/{name}/'.format(name=self.name)
+        # 每隔多少步写一次 summary，见 summary_writer.py
+        self.summary_every = 10
 
         self.lr = 0.0002
         self.epoches = 200
 
     def get_gpus(self):
-        value = os.getenv('CUDA_VISIBLE_DEVICES', '0')
-        return len(value.split(','))
+        return multi_tower.get_gpus()
+
+    def get_towers(self):
+        return multi_tower.num_towers(self.device_type, self.towers, self.gpus)
 
     def from_cmd_line(self):
         parser = argparse.ArgumentParser()
@@ -42,21 +54,23 @@ class Config:
 class Tensors:
     def __init__(self, config: Config):
         self.config = config
-        self.sub_tensors = []
-        with tf.device('/gpu:0'):
+        devices = multi_tower.get_devices(config.device_type, config.get_towers())
+        with tf.device(devices[0]):
             self.lr = tf.placeholder(tf.float32, [], 'lr')
             opt = tf.train.AdamOptimizer(self.lr)
 
-        with tf.variable_scope('translation'):
-            for gpu_index in range(config.gpus):
-                self.sub_tensors.append(Sub_tensors(config, gpu_index, opt))
-                tf.get_variable_scope().reuse_variables()
+        self.towers = multi_tower.Towers(devices, lambda device: Sub_tensors(config, device, opt), 'translation')
+        self.sub_tensors = self.towers.towers
 
-        with tf.device('/gpu:0'):
-            self.grad = self.merge_grads()
-            self.train_op = opt.apply_gradients(self.grad)
+        with tf.device(devices[0]):
+            self.grad = self.towers.merge_grads()
+            self.accumulator = accumulate.Accumulator(opt, self.grad, config.accumulate)
+            self.train_op = self.accumulator.train_op
+            # embedding 本步实际更新的行数（各塔去重后的字数），见 multi_tower.merge_grads
+            self.rows_touched = self.towers.total_rows_touched()
             self.loss = tf.reduce_mean([ts.loss for ts in self.sub_tensors])
             tf.summary.scalar('loss', self.loss)
+            tf.summary.scalar('rows_touched', self.rows_touched)
             self.summary_op = tf.summary.merge_all()
 
             self.show_paras()
@@ -76,38 +90,10 @@ class Tensors:
         return num
 
 
-
-
-
-
-
-
-    def merge_grads(self):
-        grads = {}
-        indexed_grads = {}
-        for ts in self.sub_tensors:
-            for g, v in ts.grad:
-                if isinstance(g, tf.IndexedSlices):
-                    if v not in indexed_grads:
-                        indexed_grads[v] = []
-                    indexed_grads[v].append(g)
-                else:
-                    if v not in grads:
-                        grads[v] = []
-                    grads[v].append(g)
-
-        results = [(tf.reduce_mean(grads[v], axis = 0),v) for v in grads]
-        for v in indexed_grads:
-            indices = tf.concat([g.indices for g in indexed_grads[v]], axis = 0)
-            values = tf.concat([g.values for g in indexed_grads[v]], axis=0)
-            g = tf.IndexedSlices(values, indices)
-            results.append((g, v))
-        return results
-
 class Sub_tensors:
-    def __init__(self, config: Config, gpu_index, opt: tf.train.AdamOptimizer):
+    def __init__(self, config: Config, device, opt: tf.train.AdamOptimizer):
         self.config = config
-        with tf.device('/gpu:%d' % gpu_index):
+        with tf.device(device):
             self.x = tf.placeholder(tf.int32, [None, config.num_step1], 'x')
             self.y = tf.placeholder(tf.int32, [None, config.num_step2], 'y')
             with tf.variable_scope('encode'):
@@ -194,12 +180,11 @@ class App:
         self.config = config
         graph = tf.Graph()
         with graph.as_default():
-            conf = tf.ConfigProto()
-            conf.allow_soft_placement = True
+            conf = multi_tower.session_config(config.device_type, config.get_towers())
             self.samples = Samples(config)
             self.session = tf.Session(config = conf, graph=graph)
-            self.file_writer = tf.summary.FileWriter(logdir=config.logdir, graph=graph)
             self.tensors = Tensors(config)
+            self.file_writer = summary_writer.SummaryWriter(config.logdir, graph, self.tensors.summary_op, config.summary_every)
             self.saver = tf.train.Saver()
             try:
                 self.saver.restore(self.session, config.save_path)
@@ -208,24 +193,24 @@ class App:
 
     def train(self):
         cfg = self.config
-        batches = self.samples.num() // (cfg.gpus * cfg.batch_size)
+        self.session.run(self.tensors.accumulator.init_op)
+        batches = self.samples.num() // (cfg.get_towers() * cfg.batch_size)
         for epoch in range(cfg.epoches):
             for batch in range(batches):
                 feed_dict = {
                     self.tensors.lr: cfg.lr
                 }
-                for gpu_index in range(cfg.gpus):
+                for gpu_index in range(cfg.get_towers()):
                     x, y = self.samples.next_batch(cfg.batch_size)
                     feed_dict[self.tensors.sub_tensors[gpu_index].x] = x
                     feed_dict[self.tensors.sub_tensors[gpu_index].y] = y
-                _, loss, su = self.session.run([self.tensors.train_op,
-                                      self.tensors.loss,
-                                      self.tensors.summary_op], feed_dict)
-                self.file_writer.add_summary(su, epoch * batches + batch)
+                _, loss = self.file_writer.run(self.session, [self.tensors.accumulator.step_op(epoch * batches + batch),
+                                      self.tensors.loss], feed_dict, epoch * batches + batch)
                 print('%d/%d, loss = %f' % (epoch, batch, loss))
             self.saver.save(self.session, config.save_path)
 
     def close(self):
+        self.file_writer.close()
         self.session.close()
 
 
@@ -240,6 +225,7 @@ class App:
 
 if __name__ == '__main__':
     config = Config()
+    config.from_cmd_line()
     app = App(config)
     # app.train()
 
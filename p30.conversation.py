@@ -1,30 +1,42 @@
 import tensorflow as tf
 import numpy as np
-import os
 import argparse
+import multi_tower
+import accumulate
+import summary_writer
 
 
 class Config:
     def __init__(self):
         self.batch_size = 20
+        # 每累积多少个batch的梯度才更新一次参数，内存放不下大batch时，实际的batch大小是 batch_size * accumulate
+        self.accumulate = 1
         self.num_step1 = 50  # the length of the background
         self.num_step2 = 10  # the length of the question and answer
         self.num_units = 5
         self.levels = 2
 
+        # gpu: 每个GPU一个塔；cpu: 建立多个虚拟CPU设备，每个设备一个塔
+        self.device_type = 'gpu'
         self.gpus = self.get_gpus()
+        # 塔的数量，0 表示默认值：gpu 为 gpus，cpu 为CPU核数，可以在命令行中用 --towers 指定
+        self.towers = 0
         self.ch_size = 200
 
         self.name = 'p30'
         self.save_path = 'models/{name}/{name}'.format(name=self.name)
         self.logdir = 'logs/{name}/'.format(name=self.name)
+        # 每隔多少步写一次 summary，见 summary_writer.py
+        self.summary_every = 10
 
         self.lr = 0.0002
         self.epoches = 100
 
     def get_gpus(self):
-        value = os.getenv('CUDA_VISIBLE_DEVICES', '0')
-        return len(value.split(','))
+        return multi_tower.get_gpus()
+
+    def get_towers(self):
+        return multi_tower.num_towers(self.device_type, self.towers, self.gpus)
 
     def from_cmd_line(self):
         parser = argparse.ArgumentParser()
@@ -44,48 +56,29 @@ class Config:
 class Tensors:
     def __init__(self, config: Config):
         self.config = config
-        self.sub_tensors = []
-        with tf.device('/gpu:0'):
+        devices = multi_tower.get_devices(config.device_type, config.get_towers())
+        with tf.device(devices[0]):
             self.lr = tf.placeholder(tf.int32, [], 'lr')
             opt = tf.train.AdadeltaOptimizer(self.lr)
 
-        with tf.variable_scope('dialog'):
-            for gpu_index in range(config.gpus):
-                self.sub_tensors.append(Sub_tensors(gpu_index, config, opt))
-                tf.get_variable_scope().reuse_variables()
+        self.towers = multi_tower.Towers(devices, lambda device: Sub_tensors(device, config, opt), 'dialog')
+        self.sub_tensors = self.towers.towers
 
-        with tf.device('/gpu:0'):
-            grad = self.merge_grads()
-            self.train_op = opt.apply_gradients(grad)
+        with tf.device(devices[0]):
+            self.accumulator = accumulate.Accumulator(opt, self.towers.merge_grads(), config.accumulate)
+            self.train_op = self.accumulator.train_op
+            # embedding 本步实际更新的行数（各塔去重后的字数），见 multi_tower.merge_grads
+            self.rows_touched = self.towers.total_rows_touched()
             self.loss = tf.reduce_mean([ts.loss for ts in self.sub_tensors])
             tf.summary.scalar('loss', self.loss)
+            tf.summary.scalar('rows_touched', self.rows_touched)
             self.summary_op = tf.summary.merge_all()
 
-    def merge_grads(self):
-        indices_grads = {}
-        grads = {}
-        for ts in self.sub_tensors:
-            for g, v in ts.grad:
-                if isinstance(g, tf.IndexedSlices):
-                    if v not in indices_grads:
-                        indices_grads[v] = []
-                    indices_grads[v].append(g)
-                else:
-                    if v not in grads:
-                        grads[v] = []
-                    grads[v].append(g)
-        results = [(tf.reduce_mean(grads[v], axis = 0),v) for v in grads]
-        for v in indices_grads:
-            indices = tf.concat([g.indices for g in indices_grads[v]], axis = 0)
-            values = tf.concat([g.values for g in indices_grads[v]], axis=0)
-            g = tf.IndexedSlices(values, indices)
-            results.append((g, v))
-        return results
 
 class Sub_tensors:
-    def __init__(self, gpu_index, config: Config, opt: tf.train.AdadeltaOptimizer):
+    def __init__(self, device, config: Config, opt: tf.train.AdadeltaOptimizer):
         self.config = config
-        with tf.device('/gpu:%d' % gpu_index):
+        with tf.device(device):
             self.x = tf.placeholder(tf.int32, [None, config.num_step1], 'x')
             self.y = tf.placeholder(tf.int32, [None, config.num_step2], 'y')
             self.z = tf.placeholder(tf.int32, [None, config.num_step2], 'z')
@@ -281,8 +274,7 @@ class App:
         graph = tf.Graph()
         with graph.as_default():
             self.tensors = Tensors(config)
-            cfg = tf.ConfigProto()
-            cfg.allow_soft_placement = True
+            cfg = multi_tower.session_config(config.device_type, config.get_towers())
             self.session = tf.Session(config=cfg, graph=graph)
             self.saver = tf.train.Saver()
             try:
@@ -294,29 +286,30 @@ class App:
 
     def train(self):
         cfg = self.config
+        self.session.run(self.tensors.accumulator.init_op)
         self.samples = Samples(cfg)
 
-        writer = tf.summary.FileWriter(cfg.logdir, self.session.graph)
+        writer = summary_writer.SummaryWriter(cfg.logdir, self.session.graph, self.tensors.summary_op, cfg.summary_every)
 
         for epoch in range(cfg.epoches):
-            batches = self.samples.record_num // (cfg.gpus * cfg.batch_size)
+            batches = self.samples.record_num // (cfg.get_towers() * cfg.batch_size)
             for batch in range(batches):
                 feed_dict = {
                     self.tensors.lr: cfg.lr
                 }
 
-                for gpu_index in range(cfg.gpus):
+                for gpu_index in range(cfg.get_towers()):
                     xr, xq, y = self.samples.next_batch(cfg.batch_size)
                     feed_dict[self.tensors.sub_tensors[gpu_index].x] = xr
                     feed_dict[self.tensors.sub_tensors[gpu_index].y] = y
                     feed_dict[self.tensors.sub_tensors[gpu_index].z] = xq
 
-                _, loss, su = self.session.run(
-                    [self.tensors.train_op, self.tensors.loss, self.tensors.summary_op], feed_dict)
-                writer.add_summary(su, epoch * batches + batch)
+                _, loss = writer.run(
+                    self.session, [self.tensors.accumulator.step_op(epoch * batches + batch), self.tensors.loss], feed_dict, epoch * batches + batch)
                 print('%d/%d: loss=%.8f' % (batch, epoch, loss), flush=True)
             self.saver.save(self.session, cfg.save_path)
             print('Save the mode into ', cfg.save_path, flush=True)
+        writer.close()
 
     def predict(self):
         pass
@@ -341,7 +334,7 @@ B 的陈述,不是回答,则忽略
 '''
 if __name__ == '__main__':
     config = Config()
-    # config.from_cmd_line()
+    config.from_cmd_line()
 
     # s = Samples(config)
     # x, y, z = s.next_batch(20)
@@ -1,8 +1,10 @@
 import tensorflow as tf
 import numpy as np
-import os
 import argparse
+import time
 import cv2
+import multi_tower
+import summary_writer
 
 
 class Config:
@@ -13,18 +15,28 @@ class Config:
         self.convs = 3
         self.filters = 2
 
+        # gpu: 每个GPU一个塔；cpu: 建立多个虚拟CPU设备，每个设备一个塔
+        self.device_type = 'gpu'
         self.gpus = self.get_gpus()
+        # 塔的数量，0 表示默认值：gpu 为 gpus，cpu 为CPU核数，可以在命令行中用 --towers 指定
+        self.towers = 0
 
         self.name = 'p31'
         self.save_path = 'models/{name}/{name}'.format(name=self.name)
         self.logdir = 'logs/{name}/'.format(name=self.name)
 
         self.lr = 0.0002
+        # 1: 每步一次 session.run 完成判别器和生成器的更新；0: 原来的每步四次 session.run（每步都取summary），用来对比单步耗时
+        self.fused = 1
+        # 每隔多少步写一次 summary，见 summary_writer.py
+        self.summary_every = 10
         self.epoches = 100
 
     def get_gpus(self):
-        value = os.getenv('CUDA_VISIBLE_DEVICES', '0')
-        return len(value.split(','))
+        return multi_tower.get_gpus()
+
+    def get_towers(self):
+        return multi_tower.num_towers(self.device_type, self.towers, self.gpus)
 
     def from_cmd_line(self):
         parser = argparse.ArgumentParser()
@@ -43,20 +55,18 @@ class Config:
 class Tensors:
     def __init__(self, config: Config):
         self.config = config
-        self.sub_tensors = []
-        with tf.device('/gpu:0'):
-            self.lr = tf.placeholder(tf.int32, [], 'lr')
+        devices = multi_tower.get_devices(config.device_type, config.get_towers())
+        with tf.device(devices[0]):
+            self.lr = tf.placeholder(tf.float32, [], 'lr')
             opt = tf.train.AdadeltaOptimizer(self.lr)
 
-        with tf.variable_scope('dialog'):
-            for gpu_index in range(config.gpus):
-                self.sub_tensors.append(Sub_tensors(gpu_index, config, opt))
-                tf.get_variable_scope().reuse_variables()
+        self.towers = multi_tower.Towers(devices, lambda device: Sub_tensors(device, config, opt), 'dialog')
+        self.sub_tensors = self.towers.towers
 
-        with tf.device('/gpu:0'):
-            grad1 = self.merge_grads(lambda ts: ts.grad1)
-            grad2 = self.merge_grads(lambda ts: ts.grad2)
-            grad3 = self.merge_grads(lambda ts: ts.grad3)
+        with tf.device(devices[0]):
+            grad1 = self.towers.merge_grads(lambda ts: ts.grad1)
+            grad2 = self.towers.merge_grads(lambda ts: ts.grad2)
+            grad3 = self.towers.merge_grads(lambda ts: ts.grad3)
 
             self.train_op1 = opt.apply_gradients(grad1)
             self.train_op2 = opt.apply_gradients(grad2)
@@ -66,6 +76,19 @@ class Tensors:
             self.loss2 = tf.reduce_mean([ts.loss2 for ts in self.sub_tensors])
             self.loss3 = tf.reduce_mean([ts.loss3 for ts in self.sub_tensors])
 
+            # 融合的训练步：判别器用 loss1 + loss2 的梯度更新一次，之后再更新生成器。
+            # 三个损失和所有梯度来自同一次正向计算，生成器的梯度用的是本步更新前的判别器，
+            # 与原来三次 session.run 依次更新、每次重新正向计算的做法略有不同。
+            # 判别器的更新必须等生成器的梯度和三个损失都算完，否则它们可能读到已经更新了一半的判别器变量
+            grad2 = {v: g for g, v in grad2}
+            with tf.control_dependencies([g for g, _ in grad3] + [self.loss1, self.loss2, self.loss3]):
+                # slot变量已经由上面的 train_op1 创建，这里不会在 control_dependencies 中新建变量
+                train_dis = opt.apply_gradients([(g + grad2[v], v) for g, v in grad1])
+            with tf.control_dependencies([train_dis]):
+                grad_gen = [(tf.identity(g), v) for g, v in grad3]
+            # slot变量在 control_dependencies 之外创建
+            self.train_op = opt.apply_gradients(grad_gen)
+
             tf.summary.scalar('loss1', self.loss1)
             tf.summary.scalar('loss2', self.loss2)
             tf.summary.scalar('loss3', self.loss3)
@@ -73,33 +96,10 @@ class Tensors:
             self.summary_op = tf.summary.merge_all()
 
 
-    def merge_grads(self, func):
-        indices_grads = {}
-        grads = {}
-        for ts in self.sub_tensors:
-            for g, v in func(ts):
-                if isinstance(g, tf.IndexedSlices):
-                    if v not in indices_grads:
-                        indices_grads[v] = []
-                    indices_grads[v].append(g)
-                else:
-                    if v not in grads:
-                        grads[v] = []
-                    grads[v].append(g)
-        results = [(tf.reduce_mean(grads[v], axis = 0),v) for v in grads]
-        for v in indices_grads:
-            indices = tf.concat([g.indices for g in indices_grads[v]], axis = 0)
-            values = tf.concat([g.values for g in indices_grads[v]], axis=0)
-            g = tf.IndexedSlices(values, indices)
-            results.append((g, v))
-        return results
-
-
-
 class Sub_tensors:
-    def __init__(self, gpu_index, config: Config, opt: tf.train.AdadeltaOptimizer):
+    def __init__(self, device, config: Config, opt: tf.train.AdadeltaOptimizer):
         self.config = config
-        with tf.device('/gpu:%d' % gpu_index):
+        with tf.device(device):
             with tf.variable_scope('discriminator'):
                 self.x = tf.placeholder(tf.float32, [None, config.size, config.size], 'x')
                 x = self.x / 255
@@ -201,9 +201,8 @@ class App:
         self.samples = Samples(self.config)
         with graph.as_default():
             self.tensors = Tensors(config)
-            self.file_writer = tf.summary.FileWriter(logdir=config.logdir, graph=graph)
-            cfg = tf.ConfigProto()
-            cfg.allow_soft_placement = True
+            self.file_writer = summary_writer.SummaryWriter(config.logdir, graph, self.tensors.summary_op, config.summary_every)
+            cfg = multi_tower.session_config(config.device_type, config.get_towers())
             self.session = tf.Session(config=cfg, graph=graph)
             self.saver = tf.train.Saver()
             try:
@@ -215,22 +214,32 @@ class App:
 
     def train(self):
         config = self.config
-        batches = self.samples.num() // (config.gpus * config.batch_size)
+        batches = self.samples.num() // (config.get_towers() * config.batch_size)
+        # 平均单步耗时，fused=0/1 各跑一次即可对比
+        total_time = 0
         for epoch in range(config.epoches):
             for batch in range(batches):
                 feed_dict = {
                     self.tensors.lr:config.lr
                 }
-                for gpu_index in range(config.gpus):
+                for gpu_index in range(config.get_towers()):
                     x, z = self.samples.next_batch(config.batch_size)
                     feed_dict[self.tensors.sub_tensors[gpu_index].x] = x
                     feed_dict[self.tensors.sub_tensors[gpu_index].z] = z
-                _, loss1 = self.session.run([self.tensors.train_op1, self.tensors.loss1], feed_dict)
-                _, loss2 = self.session.run([self.tensors.train_op2, self.tensors.loss2], feed_dict)
-                _, loss3 = self.session.run([self.tensors.train_op3, self.tensors.loss3], feed_dict)
-                su = self.session.run(self.tensors.summary_op, feed_dict)
-                print('%d/%d, loss1 = %f, loss2 = %f, loss3 = %f' % (epoch, batch, loss1, loss2, loss3))
-                self.file_writer.add_summary(su, epoch*batches+batch)
+                step = epoch * batches + batch
+                start = time.perf_counter()
+                if config.fused:
+                    fetches = [self.tensors.train_op, self.tensors.loss1, self.tensors.loss2, self.tensors.loss3]
+                    _, loss1, loss2, loss3 = self.file_writer.run(self.session, fetches, feed_dict, step)
+                else:
+                    _, loss1 = self.session.run([self.tensors.train_op1, self.tensors.loss1], feed_dict)
+                    _, loss2 = self.session.run([self.tensors.train_op2, self.tensors.loss2], feed_dict)
+                    _, loss3 = self.session.run([self.tensors.train_op3, self.tensors.loss3], feed_dict)
+                    su = self.session.run(self.tensors.summary_op, feed_dict)
+                    self.file_writer.add([su], step)
+                total_time += time.perf_counter() - start
+                print('%d/%d, loss1 = %f, loss2 = %f, loss3 = %f, %.1fms/step'
+                      % (epoch, batch, loss1, loss2, loss3, total_time / (step + 1) * 1000))
             self.saver.save(self.session, config.save_path)
 
 
@@ -253,6 +262,7 @@ class App:
 
 
     def close(self):
+        self.file_writer.close()
         self.session.close()
 
 
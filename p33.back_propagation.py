@@ -1,5 +1,7 @@
+import time
 import numpy as np
 import pandas as pd
+import mlp
 
 admissions = pd.read_csv('./data/admissions.csv')
 
@@ -25,7 +27,72 @@ def data_transform(admissions):
 def sigmoid(x):
     return 1 / (1 + np.exp(-x))
 
-def bp_work(x_train, y_train, x_test, y_test, lr = 0.01, epoches = 2000, n_hidden = 2):
+def bp_work(x_train, y_train, x_test, y_test, lr = 0.01, epoches = 2000, n_hidden = 2, batch_size = None,
+            dtype = np.float64, verbose = True):
+    """
+    整批（batch_size=None，每个epoch更新一次）或 mini batch 的矩阵化反向传播，
+    batch_size=None 时与 bp_work_per_record 的结果相同。
+    每20个epoch打印的训练损失直接复用本epoch正向传播的输出（更新权重之前的损失），不再对整个训练集重新计算一遍；
+    mini batch 时是本epoch各个batch损失的平均值
+    """
+    x_train = np.asarray(x_train, dtype=dtype)
+    y_train = np.asarray(y_train, dtype=dtype)
+    n_records, n_features = x_train.shape
+    if batch_size is None or batch_size > n_records:
+        batch_size = n_records
+
+    last_loss  = None
+    weights_input_hidden = np.random.normal(scale=1/n_features ** 0.5, size = [n_features, n_hidden]).astype(dtype)
+    weights_hidden_output = np.random.normal(scale=1/n_hidden ** 0.5, size = n_hidden).astype(dtype)
+    del_w_input_hidden = np.zeros(shape = weights_input_hidden.shape, dtype=dtype)
+    del_w_hidden_output = np.zeros(shape = weights_hidden_output.shape, dtype=dtype)
+    order = np.arange(n_records)
+
+    for e in range(1, epoches):
+        if batch_size < n_records:
+            np.random.shuffle(order)
+        squared_error = 0.0
+        for i in range(0, n_records, batch_size):
+            if batch_size < n_records:
+                x, y = x_train[order[i: i + batch_size]], y_train[order[i: i + batch_size]]
+            else:
+                x, y = x_train, y_train
+            hidden_output = sigmoid(np.dot(x, weights_input_hidden))  # n, n_hidden
+            output = sigmoid(np.dot(hidden_output, weights_hidden_output))  # n
+
+            error = output - y
+            error_term = error * output * (1 - output)
+            hidden_error_term = np.outer(error_term, weights_hidden_output) * hidden_output * (1 - hidden_output)
+
+            # 所有记录的梯度之和就是一次矩阵乘法
+            np.dot(hidden_output.T, error_term, out=del_w_hidden_output)
+            np.dot(x.T, hidden_error_term, out=del_w_input_hidden)
+            weights_input_hidden -= lr * del_w_input_hidden / len(x)
+            weights_hidden_output -= lr * del_w_hidden_output / len(x)
+            squared_error += np.dot(error, error)
+
+        if verbose and e % 20 == 0:
+            loss = squared_error / n_records
+            if last_loss and loss > last_loss:
+                print('loss is increasing!')
+            else:
+                print('train loss=', loss)
+            last_loss = loss
+
+    hidden = sigmoid(np.dot(np.asarray(x_test, dtype=dtype), weights_input_hidden))
+    out = sigmoid(np.dot(hidden, weights_hidden_output))
+    predict = out > 0.5
+    acc = np.mean(predict == np.asarray(y_test))
+    print(acc)
+    return weights_input_hidden, weights_hidden_output
+
+
+def bp_work_per_record(x_train, y_train, x_test, y_test, lr = 0.01, epoches = 2000, n_hidden = 2, verbose = True):
+    """
+    逐条记录循环累加梯度的版本，保留作为对照
+    """
+    x_train = np.asarray(x_train, dtype=np.float64)
+    y_train = np.asarray(y_train, dtype=np.float64)
     n_records, n_features = x_train.shape
 
     last_loss  = None
@@ -36,7 +103,7 @@ def bp_work(x_train, y_train, x_test, y_test, lr = 0.01, epoches = 2000, n_hidde
         del_w_input_hidden = np.zeros(shape = weights_input_hidden.shape)
         del_w_hidden_output = np.zeros(shape = weights_hidden_output.shape)
 
-        for x, y in zip(x_train.values, y_train):
+        for x, y in zip(x_train, y_train):
             hidden_input = np.dot(x, weights_input_hidden)
             hidden_output = sigmoid(hidden_input)
             output = sigmoid(np.dot(hidden_output, weights_hidden_output))
@@ -54,7 +121,7 @@ def bp_work(x_train, y_train, x_test, y_test, lr = 0.01, epoches = 2000, n_hidde
         weights_input_hidden -= lr * del_w_input_hidden / n_records
         weights_hidden_output -= lr * del_w_hidden_output / n_records
 
-        if e % 20 == 0:
+        if verbose and e % 20 == 0:
             hidden = sigmoid(np.dot(x_train, weights_input_hidden))
             out = sigmoid(np.dot(hidden, weights_hidden_output))
             loss = np.mean((out - y_train) ** 2)
@@ -64,16 +131,61 @@ def bp_work(x_train, y_train, x_test, y_test, lr = 0.01, epoches = 2000, n_hidde
                 print('train loss=', loss)
             last_loss = loss
 
-    hidden = sigmoid(np.dot(x_test, weights_input_hidden))
+    hidden = sigmoid(np.dot(np.asarray(x_test, dtype=np.float64), weights_input_hidden))
     out = sigmoid(np.dot(hidden, weights_hidden_output))
     predict = out > 0.5
-    acc = np.mean(predict == y_test)
+    acc = np.mean(predict == np.asarray(y_test))
     print(acc)
+    return weights_input_hidden, weights_hidden_output
+
+
+def mlp_work(x_train, y_train, x_test, y_test, lr = 0.01, epoches = 2000, n_hidden = 2, batch_size = None,
+             optimizer = None, dtype = np.float64, verbose = True):
+    """
+    用 mlp.MLP 训练同样结构的网络（无偏置、隐藏层和输出层都是sigmoid），optimizer 默认是 SGD(lr)
+    """
+    x_train = np.asarray(x_train, dtype=dtype)
+    y_train = np.asarray(y_train, dtype=dtype)
+    n_records, n_features = x_train.shape
+    if batch_size is None or batch_size > n_records:
+        batch_size = n_records
+    network = mlp.MLP([n_features, n_hidden, 1], 'sigmoid', 'sigmoid',
+                      mlp.SGD(lr) if optimizer is None else optimizer, bias=False, dtype=dtype)
 
+    last_loss = None
+    order = np.arange(n_records)
+    for e in range(1, epoches):
+        if batch_size < n_records:
+            np.random.shuffle(order)
+        loss = 0.0
+        for i in range(0, n_records, batch_size):
+            index = order[i: i + batch_size]
+            loss += network.train_batch(x_train[index], y_train[index]) * len(index)
+
+        if verbose and e % 20 == 0:
+            loss /= n_records
+            if last_loss and loss > last_loss:
+                print('loss is increasing!')
+            else:
+                print('train loss=', loss)
+            last_loss = loss
 
+    predict = network.predict(np.asarray(x_test, dtype=dtype))[:, 0] > 0.5
+    acc = np.mean(predict == np.asarray(y_test))
+    print(acc)
+    return network
 
 
 if __name__ == '__main__':
     #explor_data(admissions)
     x_train, y_train, x_test, y_test = data_transform(admissions)
-    bp_work(x_train, y_train, x_test, y_test, lr = 0.01, epoches = 2000, n_hidden = 2)
\ No newline at end of file
+    for name, work, kwargs in (('per_record', bp_work_per_record, {}),
+                               ('batched', bp_work, {}),
+                               ('batched_float32', bp_work, {'dtype': np.float32}),
+                               ('mini_batch_32', bp_work, {'batch_size': 32}),
+                               ('mlp_sgd', mlp_work, {}),
+                               ('mlp_adam_32', mlp_work, {'batch_size': 32, 'optimizer': mlp.Adam(0.01)})):
+        np.random.seed(42)
+        start = time.perf_counter()
+        work(x_train, y_train, x_test, y_test, lr = 0.01, epoches = 2000, n_hidden = 2, **kwargs)
+        print('%s: %.3fs' % (name, time.perf_counter() - start))
\ No newline at end of file
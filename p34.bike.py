@@ -1,7 +1,16 @@
 
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+import mlp
 
 
 """
@@ -19,10 +28,23 @@ pd.set_option('display.max_colwidth', 1000)
 
 # 读取数据
 data_path = './data/bike_sharing/hour.csv'
-rides = pd.read_csv(data_path)
-
-
-def f1():
+# 预处理结果的缓存目录，按csv内容的哈希值分子目录
+cache_dir = './cache/bike_sharing'
+
+# 流式读取时使用的固定类别表：不依赖某一块数据里实际出现了哪些取值，每一块的哑变量列都相同
+dummy_vocabulary = {
+    'season': list(range(1, 5)),
+    'weathersit': list(range(1, 5)),
+    'mnth': list(range(1, 13)),
+    'hr': list(range(24)),
+    'weekday': list(range(7)),
+}
+quant_features = ['casual', 'registered', 'cnt', 'temp', 'hum', 'windspeed']
+target_fields = ['cnt', 'casual', 'registered']
+fields_to_drop = ['instant', 'dteday', 'season', 'weathersit', 'weekday', 'atemp', 'mnth', 'workingday', 'hr']
+
+
+def f1(rides):
     print(rides.head())
     print(rides.describe())
     rides.info()
@@ -58,7 +80,6 @@ def f3(data):
     连续变量的数据标准化
     注意:cnt 就是target
     """
-    quant_features = ['casual', 'registered', 'cnt', 'temp', 'hum', 'windspeed']
     # 将换算因子进行保存，以便在预测的时候还原数据。
     scaled_features = {}
     for each in quant_features:
@@ -95,12 +116,13 @@ def f5(features , targets):
 
 
 class NeuralNetwork(object):
-    def __init__(self, input_nodes, hidden_nodes, output_nodes, learning_rate):
+    def __init__(self, input_nodes, hidden_nodes, output_nodes, learning_rate, dtype=np.float64):
         """
         :param input_nodes:   输入的节点数量 （特征数量）
         :param hidden_nodes:  隐藏层节点数量
         :param output_nodes:  输出层节点数量
         :param learning_rate:
+        :param dtype:         权重和计算使用的浮点类型，np.float32 更快、更省内存
         """
         # Set number of nodes in input, hidden and output layers.
         self.input_nodes = input_nodes
@@ -113,8 +135,15 @@ class NeuralNetwork(object):
 
         self.weights_hidden_to_output = np.random.normal(0.0, self.hidden_nodes ** -0.5,
                                                          size=(self.hidden_nodes, self.output_nodes))
+        self.dtype = dtype
+        self.weights_input_to_hidden = self.weights_input_to_hidden.astype(dtype)
+        self.weights_hidden_to_output = self.weights_hidden_to_output.astype(dtype)
         self.lr = learning_rate
 
+        # 预先分配好梯度的缓存，每次训练直接写入，不再重复申请内存
+        self.delta_weights_i_h = np.zeros(self.weights_input_to_hidden.shape, dtype)
+        self.delta_weights_h_o = np.zeros(self.weights_hidden_to_output.shape, dtype)
+
         # TODO: 设置 self.activation_function 来部署 sigmoid 函数
         self.activation_function = lambda x: 1/(1+np.exp(-x))
 
@@ -124,7 +153,37 @@ class NeuralNetwork(object):
         # self.activation_function = sigmoid
 
     def train(self, features, targets):
-        ''' 使用 batch==1 的features and targets训练网络
+        ''' 整个mini batch一起用矩阵运算做正向、反向传播，结果与 train_per_record 相同
+            Arguments
+            ---------
+            features: 2D array, each row is one data record, each column is a feature
+            targets: 1D array of target values (或 n_records x output_nodes 的2D array)
+        '''
+        X = np.asarray(features, dtype=self.dtype)
+        y = np.asarray(targets, dtype=self.dtype).reshape(len(X), -1)
+        n_records = X.shape[0]
+
+        # 1、正向传播
+        hidden_outputs = self.activation_function(np.matmul(X, self.weights_input_to_hidden))  # n, hidden
+        final_outputs = np.matmul(hidden_outputs, self.weights_hidden_to_output)  # n, output
+
+        # 2、反向传播
+        output_error_term = final_outputs - y
+        hidden_error = np.matmul(output_error_term, self.weights_hidden_to_output.T)
+        hidden_error_term = hidden_error * hidden_outputs * (1 - hidden_outputs)
+
+        # 所有记录的梯度累加就是一次矩阵乘法
+        np.matmul(X.T, hidden_error_term, out=self.delta_weights_i_h)
+        np.matmul(hidden_outputs.T, output_error_term, out=self.delta_weights_h_o)
+
+        # 更新权重
+        self.delta_weights_h_o *= self.lr / n_records
+        self.delta_weights_i_h *= self.lr / n_records
+        self.weights_hidden_to_output -= self.delta_weights_h_o
+        self.weights_input_to_hidden -= self.delta_weights_i_h
+
+    def train_per_record(self, features, targets):
+        ''' 使用 batch==1 的features and targets训练网络（逐条记录循环，保留作为对照）
             Arguments
             ---------
             features: 2D array, each row is one data record, each column is a feature
@@ -175,7 +234,8 @@ class NeuralNetwork(object):
         features: 1D array of feature values
         '''
         # 部署正向传播
-        hidden_inputs = np.matmul(features.values, self.weights_input_to_hidden)
+        features = np.asarray(getattr(features, 'values', features), dtype=self.dtype)
+        hidden_inputs = np.matmul(features, self.weights_input_to_hidden)
         hidden_outputs = self.activation_function(hidden_inputs)
 
         # TODO: 输出层
@@ -190,64 +250,623 @@ def MSE(y, Y):
 
 # 显示训练过程中的训练 和 验证损失
 def show(losses):
-    plt.plot(losses['train'], label='Training loss')
-    plt.plot(losses['validation'], label='Validation loss')
+    epochs = losses.get('epoch', range(len(losses['train'])))
+    plt.plot(epochs, losses['train'], label='Training loss')
+    plt.plot(epochs, losses['validation'], label='Validation loss')
     plt.legend()
     _ = plt.ylim()
     plt.show()
 
 
-def test(network, scaled_features, test_features, test_targets, rides):
+def test(network, scaled_features, test_features, test_targets, test_dates):
     fig, ax = plt.subplots(figsize=(8, 4))
     mean, std = scaled_features['cnt']
     predictions = network.run(test_features).T * std + mean
     ax.plot(predictions[0], label='Prediction')
-    ax.plot((test_targets['cnt'] * std + mean).values, label='Data')
+    ax.plot(test_targets[:, 0] * std + mean, label='Data')
     ax.set_xlim(right=len(predictions))
     ax.legend()
 
-    dates = pd.to_datetime(rides.ix[test_features.index]['dteday'])
+    dates = pd.to_datetime(pd.Series(test_dates))
     dates = dates.apply(lambda d: d.strftime('%b %d'))
     ax.set_xticks(np.arange(len(dates))[12::24])
     _ = ax.set_xticklabels(dates[12::24], rotation=45)
 
 
-if __name__ == '__main__':
-    # f1()
+def preprocess(rides):
+    """
+    f2 ~ f5 的完整预处理，返回各个数据集的 float32 数组，以及 scaled_features 等元信息
+    """
     data = f2(rides)
     data, scaled_features = f3(data)
-    # print(data.head())
     features, targets, test_features, test_targets = f4(data)
-
     train_features, train_targets, val_features, val_targets = f5(features, targets)
-    print(train_features)
-    # # todo 设置超参数 ###
-    epochs = 2000        # 迭代次数
-    learning_rate = 0.5  # 学习率
-    hidden_nodes = 8   # 隐藏层节点数量，决定你模型的复杂度。
-    output_nodes = 1   # 输出层的节点数量。
+    arrays = {
+        'train_features': train_features, 'train_targets': train_targets,
+        'val_features': val_features, 'val_targets': val_targets,
+        'test_features': test_features, 'test_targets': test_targets,
+    }
+    meta = {
+        'scaled_features': {name: [float(v) for v in value] for name, value in scaled_features.items()},
+        'feature_columns': list(features.columns),
+        'target_columns': list(targets.columns),
+        'test_dates': list(rides.loc[test_features.index, 'dteday']),
+    }
+    return {name: frame.values.astype(np.float32) for name, frame in arrays.items()}, meta
+
+
+def load_dataset(path=data_path, cache=cache_dir):
+    """
+    以csv内容的sha1为键缓存预处理结果：各数据集存成 .npy，scaled_features 等存成 meta.json。
+    命中缓存时不再调用pandas，直接以内存映射（只读）的方式打开 .npy 文件。
+    """
+    with open(path, 'rb') as f:
+        key = hashlib.sha1(f.read()).hexdigest()
+    folder = os.path.join(cache, key)
+    meta_path = os.path.join(folder, 'meta.json')
+    if not os.path.exists(meta_path):
+        arrays, meta = preprocess(pd.read_csv(path))
+        os.makedirs(folder, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(folder, name + '.npy'), array)
+        # meta.json 最后写入，它存在就说明缓存是完整的
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    arrays = {}
+    for name in ('train_features', 'train_targets', 'val_features', 'val_targets', 'test_features', 'test_targets'):
+        arrays[name] = np.load(os.path.join(folder, name + '.npy'), mmap_mode='r')
+    return arrays, meta
+
+
+class RunningStats:
+    """
+    Welford 算法按块累计均值和方差，数据只需要读一遍，内存占用与数据量无关。
+    每一块先求出块内的均值和平方差之和，再与之前的结果合并（Chan 的合并公式）
+    """
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.count = 0
+        self.mean = np.zeros(len(self.columns))
+        self.m2 = np.zeros(len(self.columns))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if n == 0:
+            return
+        mean = values.mean(axis=0)
+        m2 = ((values - mean) ** 2).sum(axis=0)
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+    @property
+    def std(self):
+        # 与 pandas 的 std 一致，使用样本标准差（ddof=1）
+        return np.sqrt(self.m2 / max(self.count - 1, 1))
+
+    def scaled_features(self):
+        return {name: [float(m), float(s)] for name, m, s in zip(self.columns, self.mean, self.std)}
+
+
+def read_chunks(path=data_path, chunksize=100000):
+    """
+    分块读取csv，按固定类别表生成哑变量，返回 (特征DataFrame, 目标DataFrame) 的生成器，
+    列的顺序与 preprocess 得到的 feature_columns / target_columns 相同。
+    不在类别表中的取值，对应的哑变量全部为0
+    """
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        dummies = [pd.get_dummies(pd.Categorical(chunk[each], categories=vocabulary), prefix=each, dtype=np.float32)
+                   .set_axis(chunk.index) for each, vocabulary in dummy_vocabulary.items()]
+        data = pd.concat([chunk.drop(fields_to_drop, axis=1)] + dummies, axis=1)
+        yield data.drop(target_fields, axis=1), data[target_fields]
 
-    n_features = train_features.shape[1]
 
-    network = NeuralNetwork(n_features, hidden_nodes, output_nodes, learning_rate)
+def fit_stream(path=data_path, chunksize=100000):
+    """
+    统计连续变量的均值、标准差和总行数，只需要扫描一遍文件；
+    训练时 stream_standardized / stream_batches 每一轮还会重新读一遍文件，一边读一边标准化
+    """
+    stats = RunningStats(quant_features)
+    for features, targets in read_chunks(path, chunksize):
+        data = pd.concat([features, targets], axis=1)
+        stats.update(data[quant_features].values)
+    return stats
 
-    losses = {'train': [], 'validation': []}
-    for epoch in range(epochs):
+
+def stream_standardized(path, scaled_features, chunksize=100000, start=0, stop=None):
+    """
+    按块返回标准化后的 (features, targets) float32 数组，只包含第 start ~ stop 行
+    """
+    offset = 0
+    for features, targets in read_chunks(path, chunksize):
+        begin, end = max(start - offset, 0), len(features) if stop is None else min(stop - offset, len(features))
+        offset += len(features)
+        if begin >= end:
+            if stop is not None and offset >= stop:
+                break
+            continue
+        features, targets = features[begin:end].copy(), targets[begin:end].copy()
+        for each, (mean, std) in scaled_features.items():
+            frame = features if each in features.columns else targets
+            frame[each] = (frame[each] - mean) / std
+        yield features.values.astype(np.float32), targets.values.astype(np.float32)
+
+
+def stream_batches(path, scaled_features, batch_size=128, chunksize=100000, start=0, stop=None, shuffle=True,
+                   seed=None):
+    """
+    把标准化后的数据切成 batch_size 条一组的mini batch，返回 (features, targets[:, 0]) 的生成器。
+    shuffle=True 时在每一块内部打乱顺序；块尾不够一个batch的记录留到下一块，最后一个batch可能不满
+    """
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    rest_x = rest_y = None
+    for x, y in stream_standardized(path, scaled_features, chunksize, start, stop):
+        if shuffle:
+            order = rng.permutation(len(x))
+            x, y = x[order], y[order]
+        if rest_x is not None:
+            x, y = np.concatenate([rest_x, x]), np.concatenate([rest_y, y])
+        n = len(x) // batch_size * batch_size
+        for i in range(0, n, batch_size):
+            yield x[i: i + batch_size], y[i: i + batch_size, 0]
+        rest_x, rest_y = x[n:], y[n:]
+    if rest_x is not None and len(rest_x):
+        yield rest_x, rest_y[:, 0]
+
+
+def train_stream(network, path, scaled_features, passes=1, batch_size=128, chunksize=100000, stop=None):
+    """
+    不把数据整体读入内存，逐个mini batch训练；每一遍都重新按块读取文件
+    """
+    steps = 0
+    for _ in range(passes):
+        for X, y in stream_batches(path, scaled_features, batch_size, chunksize, stop=stop):
+            network.train(X, y)
+            steps += 1
+    return steps
+
+
+def benchmark(train_features, train_targets, epochs=200, batch_size=128, hidden_nodes=8, learning_rate=0.5):
+    """
+    同样的初始权重、同样的mini batch，对比逐条记录训练 与 整批矩阵训练（float64/float32）的耗时
+    """
+    X = np.asarray(train_features, dtype=np.float64)
+    y = np.asarray(train_targets[:, 0], dtype=np.float64)
+    batches = [np.random.randint(0, len(X), batch_size) for _ in range(epochs)]
+    base = NeuralNetwork(X.shape[1], hidden_nodes, 1, learning_rate)
+
+    result = {}
+    for name, dtype, method in (('per_record', np.float64, 'train_per_record'),
+                                ('batched', np.float64, 'train'),
+                                ('batched_float32', np.float32, 'train')):
+        network = NeuralNetwork(X.shape[1], hidden_nodes, 1, learning_rate, dtype)
+        network.weights_input_to_hidden[:] = base.weights_input_to_hidden
+        network.weights_hidden_to_output[:] = base.weights_hidden_to_output
+        features = X.astype(dtype)
+        start = time.perf_counter()
+        for batch in batches:
+            getattr(network, method)(features[batch], y[batch])
+        cost = time.perf_counter() - start
+        result[name] = {'seconds': cost,
+                        'rows_per_second': epochs * batch_size / cost,
+                        'train_loss': MSE(network.run(features).T, y)}
+    return result
+
+
+class EvalSchedule:
+    """
+    训练过程中的评估计划：每 every 次迭代评估一次，可以只用固定的一部分样本评估，
+    验证损失低于 target_loss 时提前结束训练
+    """
+    def __init__(self, every=1, sample_size=None, target_loss=None, seed=0):
+        """
+        :param every:       每隔多少次迭代评估一次
+        :param sample_size: 训练集、验证集各取多少条记录评估，None表示全部
+        :param target_loss: 验证损失低于该值时停止训练（作业要求是0.4），None表示不提前停止
+        :param seed:        抽样的随机种子，抽样只做一次，保证每次评估的样本相同
+        """
+        self.every = every
+        self.sample_size = sample_size
+        self.target_loss = target_loss
+        self.seed = seed
+
+    def prepare(self, train_features, train_targets, val_features, val_targets):
+        """
+        预先取出评估要用的连续数组，训练过程中不再做任何索引和拷贝
+        """
+        rng = np.random.RandomState(self.seed)
+        self.train = self._sample(rng, train_features, train_targets)
+        self.val = self._sample(rng, val_features, val_targets)
+        self.full_val = (np.ascontiguousarray(val_features), np.ascontiguousarray(val_targets[:, 0]))
+
+    def _sample(self, rng, features, targets):
+        if self.sample_size is None or self.sample_size >= len(features):
+            return np.ascontiguousarray(features), np.ascontiguousarray(targets[:, 0])
+        index = np.sort(rng.choice(len(features), self.sample_size, replace=False))
+        return np.take(features, index, axis=0), np.take(targets[:, 0], index)
+
+    def due(self, epoch, epochs):
+        return epoch % self.every == 0 or epoch == epochs - 1
+
+    def evaluate(self, network):
+        train_loss = MSE(network.run(self.train[0]).T, self.train[1])
+        val_loss = MSE(network.run(self.val[0]).T, self.val[1])
+        return train_loss, val_loss
+
+    def reached(self, network, val_loss):
+        """
+        抽样的验证损失达到目标后，再用完整的验证集确认一次
+        """
+        if self.target_loss is None or val_loss >= self.target_loss:
+            return False
+        if self.sample_size is not None:
+            val_loss = MSE(network.run(self.full_val[0]).T, self.full_val[1])
+        return val_loss < self.target_loss
+
+
+class BatchSampler:
+    """
+    按整数位置从连续的NumPy数组中取mini batch，不经过pandas的标签索引：
+    mode='random'     每次有放回地随机抽取 batch_size 个位置（与原来的 np.random.choice 相同）
+    mode='shuffle'    每轮（遍历一遍训练集）打乱一次顺序，依次取其中连续的一段位置
+    mode='sequential' 不打乱，依次返回切片视图，完全不拷贝
+    random/shuffle 用 np.take 把数据收集到预先分配好的缓存中，每一步都复用同一块内存
+    """
+    modes = ('random', 'shuffle', 'sequential')
+    block_size = 64
+
+    def __init__(self, features, targets, batch_size=128, mode='random', seed=None):
+        if mode not in self.modes:
+            raise Exception('mode must be one of %s, but got %s' % (self.modes, mode))
+        self.features = np.ascontiguousarray(features)
+        self.targets = np.ascontiguousarray(targets)
+        self.n_records = len(self.features)
+        self.batch_size = min(batch_size, self.n_records)
+        self.mode = mode
+        self.rng = np.random if seed is None else np.random.RandomState(seed)
+
+        self._x = np.empty((self.batch_size,) + self.features.shape[1:], self.features.dtype)
+        self._y = np.empty((self.batch_size,) + self.targets.shape[1:], self.targets.dtype)
+        self._block = np.empty((0, self.batch_size), np.intp)
+        self._order = np.arange(self.n_records)
+        self._position = self.n_records
+
+    def _positions(self):
+        if self.mode == 'random':
+            # 一次生成后面 block_size 个batch的位置，摊薄调用随机数生成器的开销
+            if self._position >= len(self._block):
+                self._block = self.rng.randint(0, self.n_records, (self.block_size, self.batch_size))
+                self._position = 0
+            self._position += 1
+            return self._block[self._position - 1]
+        if self._position + self.batch_size > self.n_records:
+            # 剩下的记录不够一个batch时开始新的一轮
+            self.rng.shuffle(self._order)
+            self._position = 0
+        index = self._order[self._position: self._position + self.batch_size]
+        self._position += self.batch_size
+        return index
+
+    def next(self):
+        """
+        返回 (features, targets)。返回的是共用的缓存或视图，下一次调用时会被覆盖
+        """
+        if self.mode == 'sequential':
+            if self._position + self.batch_size > self.n_records:
+                self._position = 0
+            start, self._position = self._position, self._position + self.batch_size
+            return self.features[start: self._position], self.targets[start: self._position]
+        index = self._positions()
+        # 位置一定合法，mode='clip' 让 np.take 直接写入 out，而不是先写到临时缓存
+        np.take(self.features, index, axis=0, out=self._x, mode='clip')
+        np.take(self.targets, index, axis=0, out=self._y, mode='clip')
+        return self._x, self._y
+
+
+def train_model(network, train_features, train_targets, val_features, val_targets, epochs, schedule=None,
+                verbose=True, sampler=None):
+    if schedule is None:
+        schedule = EvalSchedule()
+    schedule.prepare(train_features, train_targets, val_features, val_targets)
+    if sampler is None:
         # 每次随机从训练数据集中抽取128条记录作为训练
-        batch = np.random.choice(train_features.index, size=128)
-        X, y = train_features.ix[batch].values, train_targets.ix[batch]['cnt']
+        sampler = BatchSampler(train_features, train_targets[:, 0], 128)
+
+    losses = {'epoch': [], 'train': [], 'validation': []}
+    for epoch in range(epochs):
+        X, y = sampler.next()
 
         network.train(X, y)
 
+        if not schedule.due(epoch, epochs):
+            continue
         # 打印出训练过程
-        train_loss = MSE(network.run(train_features).T, train_targets['cnt'].values)
-        val_loss = MSE(network.run(val_features).T, val_targets['cnt'].values)
-        if epoch % 80 == 0:
+        train_loss, val_loss = schedule.evaluate(network)
+        if verbose and epoch % 80 < schedule.every:
             print('训练迭代次数：{},训练损失:{} ,验证损失:'
                   '{}'.format(epoch, train_loss, val_loss))
 
+        losses['epoch'].append(epoch)
         losses['train'].append(train_loss)
         losses['validation'].append(val_loss)
+        if schedule.reached(network, val_loss):
+            if verbose:
+                print('训练迭代次数：{},验证损失已低于{}，提前结束训练'.format(epoch, schedule.target_loss))
+            break
+    return losses
+
 
-    show(losses)
-    test(network, scaled_features, test_features, test_targets, rides)
+# 工作进程（超参数搜索、滚动回测）中，挂接到共享内存上的只读数组
+_shared_arrays = {}
+_shared_blocks = []
+
+
+def _share(arrays):
+    """
+    把数组复制到共享内存中（只复制这一次），返回 (共享内存块, 各数组的描述)
+    """
+    blocks = []
+    specs = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def _attach(specs):
+    """
+    工作进程的初始化函数：按描述挂接共享内存，得到只读的ndarray视图，不拷贝数据
+    """
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        array = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        _shared_blocks.append(block)
+        _shared_arrays[name] = array
+
+
+def _train_config(config):
+    np.random.seed(config['seed'])
+    a = _shared_arrays
+    start = time.perf_counter()
+    network = NeuralNetwork(a['train_features'].shape[1], config['hidden_nodes'], 1, config['learning_rate'],
+                            np.float32)
+    schedule = EvalSchedule(every=config['epochs'])
+    losses = train_model(network, a['train_features'], a['train_targets'], a['val_features'], a['val_targets'],
+                         config['epochs'], schedule, verbose=False)
+    result = dict(config)
+    result['train_loss'] = float(losses['train'][-1])
+    result['val_loss'] = float(losses['validation'][-1])
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def sweep(arrays, hidden_nodes_list, learning_rates, epochs_list, workers=None):
+    """
+    在多个工作进程中并行训练所有超参数组合，训练/验证数据通过共享内存只保存一份。
+    返回按验证损失从小到大排序的结果表（DataFrame）
+    """
+    configs = []
+    for seed, (hidden_nodes, learning_rate, epochs) in enumerate(
+            itertools.product(hidden_nodes_list, learning_rates, epochs_list)):
+        configs.append({'hidden_nodes': hidden_nodes, 'learning_rate': learning_rate, 'epochs': epochs,
+                        'seed': seed})
+
+    names = ('train_features', 'train_targets', 'val_features', 'val_targets')
+    blocks, specs = _share({name: arrays[name] for name in names})
+    try:
+        with multiprocessing.Pool(workers, initializer=_attach, initargs=(specs,)) as pool:
+            results = pool.map(_train_config, configs, chunksize=1)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    table = pd.DataFrame(results).sort_values(['val_loss', 'seconds']).reset_index(drop=True)
+    table.index += 1
+    return table
+
+
+def rolling_origins(n_records, horizon, step, windows):
+    """
+    滚动预测起点：最后一个窗口正好到数据末尾，往前每隔 step 条记录一个起点，共 windows 个
+    """
+    last = n_records - horizon
+    origins = [last - k * step for k in range(windows - 1, -1, -1)]
+    if origins[0] <= 0:
+        raise Exception('not enough records for %d windows of %d records with step %d' % (windows, horizon, step))
+    return origins
+
+
+def standardize_before(features, targets, origin, horizon, scale_columns, cnt_scale):
+    """
+    缓存中的数组是用整个序列的均值、标准差标准化的，回测时相当于偷看了 origin 之后的数据。
+    这里只用 origin 之前的记录重新标准化连续变量（scale_columns 列和全部 target），
+    标准化是线性变换，在已标准化的数据上再做一次，等价于直接用 origin 之前的原始数据计算换算因子。
+    返回 [0, origin + horizon) 的特征、target，以及新的 cnt 换算因子
+    """
+    stop = origin + horizon
+    features = np.array(features[:stop])
+    targets = np.array(targets[:stop])
+    columns = list(scale_columns)
+    mean, std = features[:origin, columns].mean(axis=0), features[:origin, columns].std(axis=0, ddof=1)
+    features[:, columns] = (features[:, columns] - mean) / std
+    mean, std = targets[:origin].mean(axis=0), targets[:origin].std(axis=0, ddof=1)
+    targets[:] = (targets - mean) / std
+    # target 的第0列是 cnt
+    cnt_mean, cnt_std = cnt_scale
+    return features, targets, [cnt_mean + cnt_std * float(mean[0]), cnt_std * float(std[0])]
+
+
+def fit_window(network, features, targets, origin, horizon, epochs, cnt_scale, scale_columns=None):
+    """
+    用 origin 之前的全部记录训练（扩展窗口），然后一次性预测 [origin, origin + horizon) 并打分。
+    scale_columns 为连续特征的列号，给出时先用 standardize_before 只按 origin 之前的记录重新标准化；
+    为 None 时直接使用传入的数组，如果它们是用整个序列标准化的，结果会混入未来数据的信息
+    """
+    start = time.perf_counter()
+    if scale_columns is not None:
+        features, targets, cnt_scale = standardize_before(features, targets, origin, horizon, scale_columns,
+                                                          cnt_scale)
+    window_x, window_y = features[origin: origin + horizon], targets[origin: origin + horizon]
+    schedule = EvalSchedule(every=epochs)
+    train_model(network, features[:origin], targets[:origin], window_x, window_y, epochs, schedule, verbose=False)
+    prediction = network.run(window_x)[:, 0]
+    mean, std = cnt_scale
+    error = (prediction - window_y[:, 0]) * std
+    return {'origin': origin,
+            'train_records': origin,
+            'mse': MSE(prediction, window_y[:, 0]),
+            'mae': float(np.mean(np.abs(error))),
+            'rmse': float(np.sqrt(np.mean(error ** 2))),
+            'seconds': time.perf_counter() - start}
+
+
+def _backtest_window(task):
+    np.random.seed(task['seed'])
+    features, targets = _shared_arrays['features'], _shared_arrays['targets']
+    network = NeuralNetwork(features.shape[1], task['hidden_nodes'], 1, task['learning_rate'], np.float32)
+    return fit_window(network, features, targets, task['origin'], task['horizon'], task['epochs'], task['cnt_scale'],
+                      task['scale_columns'])
+
+
+def backtest(features, targets, scaled_features, feature_columns, origins, horizon, epochs=2000, hidden_nodes=8,
+             learning_rate=0.5, warm_start=False, workers=None):
+    """
+    滚动起点回测，返回每个窗口一行的误差表（mse 是标准化后的，mae/rmse 换算回骑行次数）。
+    features/targets 是按整个序列标准化的数组，feature_columns 为特征的列名；
+    每个窗口都只用起点之前的记录重新标准化（见 standardize_before），不会用到未来数据的均值、标准差。
+    warm_start=False：每个窗口都重新初始化、重新训练，窗口之间互不依赖，在多个工作进程中并行，数据放在共享内存里；
+    warm_start=True：同一个网络依次在每个起点上继续训练，只能按顺序执行
+    """
+    cnt_scale = scaled_features['cnt']
+    scale_columns = [i for i, name in enumerate(feature_columns) if name in quant_features]
+    if warm_start:
+        np.random.seed(0)
+        network = NeuralNetwork(features.shape[1], hidden_nodes, 1, learning_rate, np.float32)
+        results = [fit_window(network, features, targets, origin, horizon, epochs, cnt_scale, scale_columns)
+                   for origin in origins]
+    else:
+        tasks = [{'origin': origin, 'horizon': horizon, 'epochs': epochs, 'hidden_nodes': hidden_nodes,
+                  'learning_rate': learning_rate, 'cnt_scale': cnt_scale, 'scale_columns': scale_columns,
+                  'seed': seed}
+                 for seed, origin in enumerate(origins)]
+        blocks, specs = _share({'features': features, 'targets': targets})
+        try:
+            with multiprocessing.Pool(workers, initializer=_attach, initargs=(specs,)) as pool:
+                results = pool.map(_backtest_window, tasks, chunksize=1)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', action='store_true', help='对比逐条记录训练和整批训练的速度')
+    parser.add_argument('--eval_every', type=int, default=20, help='每隔多少次迭代评估一次训练/验证损失')
+    parser.add_argument('--eval_sample', type=int, default=None, help='评估时训练集、验证集各抽取的记录数，默认全部')
+    parser.add_argument('--target_loss', type=float, default=None, help='验证损失低于该值时提前结束，例如 0.4')
+    parser.add_argument('--engine', default='network', choices=['network', 'mlp_sgd', 'mlp_adam'],
+                        help='network: 本文件的 NeuralNetwork；mlp_sgd/mlp_adam: mlp.py 中的 MLP')
+    parser.add_argument('--sampler', default='random', choices=BatchSampler.modes, help='mini batch的抽取方式')
+    parser.add_argument('--stream', action='store_true', help='分块读取csv，在线标准化后逐批训练（数据不整体读入内存）')
+    parser.add_argument('--chunksize', type=int, default=100000, help='流式读取时每块的行数')
+    parser.add_argument('--passes', type=int, default=10, help='流式训练时遍历数据的次数')
+    parser.add_argument('--sweep', action='store_true', help='多进程并行搜索超参数')
+    parser.add_argument('--sweep_hidden', type=int, nargs='+', default=[4, 8, 16, 32], help='隐藏层节点数量的候选值')
+    parser.add_argument('--sweep_lr', type=float, nargs='+', default=[0.1, 0.5, 1.0], help='学习率的候选值')
+    parser.add_argument('--sweep_epochs', type=int, nargs='+', default=[1000, 2000], help='迭代次数的候选值')
+    parser.add_argument('--sweep_output', default='logs/p34_sweep.csv', help='排序后的结果表保存位置')
+    parser.add_argument('--backtest', action='store_true', help='滚动起点回测，输出每个窗口的误差表')
+    parser.add_argument('--bt_windows', type=int, default=8, help='回测窗口数量')
+    parser.add_argument('--bt_horizon', type=int, default=21 * 24, help='每个窗口预测的记录数（小时）')
+    parser.add_argument('--bt_step', type=int, default=7 * 24, help='相邻两个起点间隔的记录数（小时）')
+    parser.add_argument('--bt_epochs', type=int, default=2000, help='每个窗口的迭代次数（warm_start时是继续训练的次数）')
+    parser.add_argument('--warm_start', action='store_true', help='回测时在上一个窗口的网络上继续训练')
+    parser.add_argument('--bt_output', default='logs/p34_backtest.csv', help='回测误差表保存位置')
+    parser.add_argument('--workers', type=int, default=None, help='工作进程数量，默认与CPU核数相同')
+    args = parser.parse_args()
+
+    # f1(pd.read_csv(data_path))
+    start = time.perf_counter()
+    arrays, meta = load_dataset()
+    print('加载数据耗时：%.3fs' % (time.perf_counter() - start))
+    train_features, train_targets = arrays['train_features'], arrays['train_targets']
+    val_features, val_targets = arrays['val_features'], arrays['val_targets']
+    test_features, test_targets = arrays['test_features'], arrays['test_targets']
+    scaled_features = meta['scaled_features']
+    if args.benchmark:
+        for name, r in benchmark(train_features, train_targets).items():
+            print('%-16s %.3fs, %10.0f rows/s, train loss = %.4f'
+                  % (name, r['seconds'], r['rows_per_second'], r['train_loss']))
+    elif args.stream:
+        start = time.perf_counter()
+        stats = fit_stream(data_path, args.chunksize)
+        stream_scaled = stats.scaled_features()
+        # 与 f4/f5 相同：最后21天作为测试集，再往前60天作为验证集，其余用来训练
+        train_stop, val_stop = stats.count - 81 * 24, stats.count - 21 * 24
+        stream_val = list(stream_standardized(data_path, stream_scaled, args.chunksize, train_stop, val_stop))
+        stream_val_x = np.concatenate([x for x, _ in stream_val])
+        stream_val_y = np.concatenate([y for _, y in stream_val])[:, 0]
+        network = NeuralNetwork(stream_val_x.shape[1], 8, 1, 0.5, np.float32)
+        for i in range(args.passes):
+            steps = train_stream(network, data_path, stream_scaled, 1, 128, args.chunksize, train_stop)
+            print('第{}遍，{}个batch，验证损失:{}'.format(i, steps, MSE(network.run(stream_val_x).T, stream_val_y)))
+        print('统计 %d 行，流式训练总耗时：%.2fs' % (stats.count, time.perf_counter() - start))
+    elif args.backtest:
+        # 缓存中的训练、验证、测试集按时间顺序拼起来就是完整的序列
+        features = np.concatenate([train_features, val_features, test_features])
+        targets = np.concatenate([train_targets, val_targets, test_targets])
+        dates = pd.read_csv(data_path, usecols=['dteday'])['dteday'].values
+        start = time.perf_counter()
+        origins = rolling_origins(len(features), args.bt_horizon, args.bt_step, args.bt_windows)
+        table = backtest(features, targets, scaled_features, meta['feature_columns'], origins, args.bt_horizon,
+                         args.bt_epochs, warm_start=args.warm_start, workers=args.workers)
+        table.insert(1, 'first_day', dates[table['origin']])
+        table.insert(2, 'last_day', dates[table['origin'] + args.bt_horizon - 1])
+        print(table)
+        print('%d 个窗口，平均 mae = %.1f，总耗时：%.2fs' % (len(table), table['mae'].mean(), time.perf_counter() - start))
+        os.makedirs(os.path.dirname(args.bt_output) or '.', exist_ok=True)
+        table.to_csv(args.bt_output, index=False)
+    elif args.sweep:
+        start = time.perf_counter()
+        table = sweep(arrays, args.sweep_hidden, args.sweep_lr, args.sweep_epochs, args.workers)
+        print(table)
+        print('%d 组超参数，总耗时：%.2fs' % (len(table), time.perf_counter() - start))
+        os.makedirs(os.path.dirname(args.sweep_output) or '.', exist_ok=True)
+        table.to_csv(args.sweep_output, index_label='rank')
+    else:
+        print(meta['feature_columns'], train_features.shape)
+        # # todo 设置超参数 ###
+        epochs = 2000        # 迭代次数
+        learning_rate = 0.5  # 学习率
+        hidden_nodes = 8   # 隐藏层节点数量，决定你模型的复杂度。
+        output_nodes = 1   # 输出层的节点数量。
+
+        n_features = train_features.shape[1]
+
+        if args.engine == 'network':
+            network = NeuralNetwork(n_features, hidden_nodes, output_nodes, learning_rate, np.float32)
+        else:
+            optimizer = mlp.SGD(learning_rate) if args.engine == 'mlp_sgd' else mlp.Adam(0.01)
+            network = mlp.MLP([n_features, hidden_nodes, output_nodes], 'sigmoid', 'identity', optimizer,
+                              bias=False, dtype=np.float32)
+        schedule = EvalSchedule(args.eval_every, args.eval_sample, args.target_loss)
+        sampler = BatchSampler(train_features, train_targets[:, 0], 128, args.sampler)
+        losses = train_model(network, train_features, train_targets, val_features, val_targets, epochs, schedule,
+                             sampler=sampler)
+
+        show(losses)
+        test(network, scaled_features, test_features, test_targets, meta['test_dates'])
@@ -0,0 +1,95 @@
+import tensorflow as tf
+import atexit
+import queue
+import threading
+
+
+"""
+节流、异步的 TensorBoard summary 写入，各个 App/Poem/Mnist 类共用：
+    每隔 every 步才取一次 summary_op，其余步骤的 session.run 不再计算 summary；
+    summary 的解析和写文件在后台线程中完成，训练线程只把结果放进一个有界队列，
+    队列满时训练线程等待，内存占用不会无限增长。
+"""
+
+
+class SummaryWriter:
+    def __init__(self, logdir, graph=None, summary_op=None, every=1, queue_size=64):
+        """
+        :param logdir:     日志目录
+        :param graph:      写入日志的计算图
+        :param summary_op: 要写入的 summary，一般是 tf.summary.merge_all()，None 表示没有
+        :param every:      每隔多少步取一次 summary_op，1 表示每一步都取
+        :param queue_size: 后台线程队列的长度
+        """
+        if every < 1:
+            raise Exception('every should be at least 1, but got %s' % every)
+        self.every = every
+        self.summary_op = summary_op
+
+        self.file_writer = tf.summary.FileWriter(logdir, graph=graph)
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+        # 有的脚本退出前没有调用 close，后台线程是daemon线程，退出时把队列中剩下的summary写完
+        atexit.register(self.close)
+
+    def fetches(self, step):
+        """
+        第 step 步需要额外取的 summary op 的列表，可能为空
+        """
+        if self.summary_op is not None and step % self.every == 0:
+            return [self.summary_op]
+        return []
+
+    def add(self, summaries, step):
+        """
+        把 session.run 得到的 summary（序列化的字符串）交给后台线程写入
+        """
+        self._check()
+        for su in summaries:
+            self.queue.put((su, step))
+
+    def run(self, session, fetches, feed_dict, step):
+        """
+        代替 session.run(fetches, feed_dict)：按需要在同一次 session.run 中取 summary 并交给后台线程，
+        返回 fetches 的结果
+        """
+        summaries = self.fetches(step)
+        result = session.run(list(fetches) + summaries, feed_dict)
+        self.add(result[len(fetches):], step)
+        return result[:len(fetches)]
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self.file_writer.add_summary(*item)
+            except Exception as e:
+                # 在训练线程下一次调用 add、flush 或 close 时报告
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            raise Exception('failed to write summary: %s' % self.error)
+
+    def flush(self):
+        """
+        等待队列中的 summary 都交给 FileWriter，再把 FileWriter 的缓存写到文件
+        """
+        self.queue.join()
+        self.file_writer.flush()
+        self._check()
+
+    def close(self):
+        # 已经显式关闭的不必在退出时再关闭一次，也不再让atexit引用这个对象
+        atexit.unregister(self.close)
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.file_writer.close()
+        self._check()